@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+# Fecha base de los servicios sinteticos
+FECHA_INICIO = pd.Timestamp('2023-01-01')
+
+
+def _horas(segundos: np.ndarray, nulos: np.ndarray) -> pd.Series:
+    # Objetos datetime.time como los que entrega psycopg2 para columnas time
+    horas = pd.Series(pd.to_datetime(segundos, unit='s').time, dtype=object)
+    horas[nulos] = None
+    return horas
+
+
+def generar(servicios: int = 10_000, seed: int = 0) -> dict:
+    """
+    Genera tablas sinteticas del OLTP de mensajeria con proporciones realistas.
+
+    :param servicios: cantidad de filas de mensajeria_servicio (10k a 10M)
+    :param seed: semilla del generador aleatorio
+    :return: diccionario tabla -> DataFrame con las columnas que usa el ETL
+    """
+    rng = np.random.default_rng(seed)
+    n_clientes = max(20, servicios // 500)
+    n_usuarios = n_clientes * 3
+    n_mensajeros = max(10, servicios // 1000)
+    n_ciudades = 12
+    n_sedes = max(5, n_clientes // 4)
+
+    ciudad = pd.DataFrame({'ciudad_id': np.arange(1, n_ciudades + 1),
+                           'nombre': [f'Ciudad {i}' for i in range(1, n_ciudades + 1)]})
+    sede = pd.DataFrame({'sede_id': np.arange(1, n_sedes + 1),
+                         'nombre': [f'Sede {i}' for i in range(1, n_sedes + 1)],
+                         'ciudad_id': rng.integers(1, n_ciudades + 1, n_sedes)})
+    cliente = pd.DataFrame({'cliente_id': np.arange(1, n_clientes + 1),
+                            'nombre': [f'Cliente {i}' for i in range(1, n_clientes + 1)]})
+    clientes_usuarioaquitoy = pd.DataFrame({'id': np.arange(1, n_usuarios + 1),
+                                            'cliente_id': rng.integers(1, n_clientes + 1, n_usuarios),
+                                            'sede_id': rng.integers(1, n_sedes + 1, n_usuarios)})
+    auth_user = pd.DataFrame({'id': np.arange(1, n_mensajeros + 1),
+                              'first_name': [f'Nombre{i}' for i in range(1, n_mensajeros + 1)],
+                              'last_name': [f'Apellido{i}' for i in range(1, n_mensajeros + 1)],
+                              'username': [f'mensajero{i}' for i in range(1, n_mensajeros + 1)]})
+    clientes_mensajeroaquitoy = pd.DataFrame({'id': np.arange(1, n_mensajeros + 1),
+                                              'user_id': np.arange(1, n_mensajeros + 1)})
+
+    # Servicios repartidos en dos años, con reasignaciones de mensajero ocasionales
+    ids = np.arange(1, servicios + 1)
+    solicitud = FECHA_INICIO.value // 10**9 + np.sort(rng.integers(0, 730 * 86400, servicios))
+    mensajero2 = np.where(rng.random(servicios) < 0.15, rng.integers(1, n_mensajeros + 1, servicios), np.nan)
+    mensajero3 = np.where(rng.random(servicios) < 0.03, rng.integers(1, n_mensajeros + 1, servicios), np.nan)
+    usuario = rng.integers(1, n_usuarios + 1, servicios)
+    mensajeria_servicio = pd.DataFrame({
+        'id': ids,
+        'cliente_id': clientes_usuarioaquitoy['cliente_id'].to_numpy()[usuario - 1],
+        'mensajero_id': rng.integers(1, n_mensajeros + 1, servicios),
+        'mensajero2_id': mensajero2,
+        'mensajero3_id': mensajero3,
+        'fecha_solicitud': pd.to_datetime(solicitud // 86400 * 86400, unit='s'),
+        'hora_solicitud': _horas(solicitud % 86400, rng.random(servicios) < 0.005),
+        'usuario_id': usuario,
+    })
+
+    # Estados 1 -> 2 -> 4 -> 5 con esperas crecientes; una parte de los servicios queda sin terminar
+    estados = []
+    instante = solicitud.copy()
+    activos = np.ones(servicios, dtype=bool)
+    for estado_id, espera_media in [(1, 120), (2, 900), (3, 300), (4, 1800), (5, 2400)]:
+        activos &= rng.random(servicios) < (0.98 if estado_id != 3 else 1.0)
+        instante = instante + rng.exponential(espera_media, servicios).astype(np.int64)
+        incluidos = activos & (rng.random(servicios) < 0.6 if estado_id == 3 else activos)
+        estados.append(pd.DataFrame({'servicio_id': ids[incluidos], 'estado_id': estado_id,
+                                     'segundos': instante[incluidos]}))
+    estados = pd.concat(estados, ignore_index=True)
+    mensajeria_estadosservicio = pd.DataFrame({
+        'id': np.arange(1, len(estados) + 1),
+        'servicio_id': estados['servicio_id'].to_numpy(),
+        'estado_id': estados['estado_id'].to_numpy(),
+        'fecha': pd.to_datetime(estados['segundos'].to_numpy() // 86400 * 86400, unit='s'),
+        'hora': _horas(estados['segundos'].to_numpy() % 86400, np.zeros(len(estados), dtype=bool)),
+    })
+
+    # Novedades: pocas por servicio, de tres tipos
+    cantidad = rng.poisson(0.4, servicios)
+    servicio_novedad = np.repeat(ids, cantidad)
+    mensajeria_novedadesservicio = pd.DataFrame({
+        'id': np.arange(1, len(servicio_novedad) + 1),
+        'servicio_id': servicio_novedad,
+        'tipo_novedad_id': rng.choice([1, 2, 3], len(servicio_novedad), p=[0.5, 0.35, 0.15]),
+    })
+
+    return {
+        'mensajeria_servicio': mensajeria_servicio,
+        'clientes_usuarioaquitoy': clientes_usuarioaquitoy,
+        'mensajeria_estadosservicio': mensajeria_estadosservicio,
+        'mensajeria_novedadesservicio': mensajeria_novedadesservicio,
+        'cliente': cliente,
+        'sede': sede,
+        'ciudad': ciudad,
+        'auth_user': auth_user,
+        'clientes_mensajeroaquitoy': clientes_mensajeroaquitoy,
+    }
@@ -0,0 +1,260 @@
+"""
+Benchmark reproducible de las etapas del ETL con datos sinteticos.
+
+Uso (desde la raiz del repositorio):
+    python -m benchmarks.run_benchmarks --servicios 100000
+    python -m benchmarks.run_benchmarks --servicios 100000 --guardar-baseline
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+import yaml
+from sqlalchemy import create_engine, text
+
+from benchmarks.generador import generar
+from etl import load, lookup, metrics, pipeline, rollups, transform
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Esquema OLAP equivalente a sqlscripts.yml para la base de datos de prueba (sqlite)
+ESQUEMA_OLAP = [
+    'create table dim_cliente (key_dim_cliente integer primary key autoincrement, id_cliente integer, nombre_cliente varchar(200))',
+    'create table dim_mensajero (key_dim_mensajero integer primary key autoincrement, id_mensajero integer, nombre_mensajero varchar(200))',
+    'create table dim_sede (key_dim_sede integer primary key autoincrement, id_sede integer, nombre_sede varchar(200), ciudad varchar(200))',
+    'create table dim_tiempo (key_dim_tiempo integer primary key, fecha date, dia_semana varchar(15), mes varchar(15), hora_dia integer)',
+    'create table hecho_servicios (key_hecho_servicios integer primary key autoincrement, key_dim_cliente integer, '
+    'key_dim_mensajero integer, key_dim_tiempo integer, key_dim_sede integer, id_servicio integer unique, '
+    'tiempo_total_espera text, tiempo_espera_inicial text, tiempo_espera_asignado text, tiempo_espera_recogido text, '
+    'tiempo_espera_en_destino text, cantidad_novedades_tipo_1 integer, cantidad_novedades_tipo_2 integer)',
+] + [
+    f'create table {tname} ({llave} integer not null, {periodo} integer not null, servicios integer, '
+    f'tiempo_total_espera_suma real, tiempo_total_espera_conteo integer, novedades_tipo_1 integer, '
+    f'novedades_tipo_2 integer, primary key ({llave}, {periodo}))'
+    for tname, (llave, periodo, _) in rollups.ROLLUPS.items()
+]
+
+
+def medir(nombre: str, funcion, memoria: bool = True, preparar=None) -> dict:
+    """
+    :param nombre: etapa medida
+    :param funcion: funcion sin argumentos que ejecuta la etapa
+    :param memoria: si es True repite la etapa con tracemalloc para medir la memoria pico
+    :param preparar: funcion sin argumentos que deja el destino vacio antes de cada pasada, fuera de la medicion
+    :return: {'etapa', 'tiempo_s', 'memoria_mb'}
+    """
+    salida = io.StringIO()
+    with contextlib.redirect_stdout(salida):
+        if preparar is not None:
+            preparar()
+        inicio = time.perf_counter()
+        funcion()
+        duracion = time.perf_counter() - inicio
+
+        pico = None
+        if memoria:
+            # Pasada aparte: tracemalloc agrega sobrecosto y alteraria el tiempo
+            if preparar is not None:
+                preparar()
+            tracemalloc.start()
+            funcion()
+            pico = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return {'etapa': nombre, 'tiempo_s': round(duracion, 4), 'memoria_mb': None if pico is None else round(pico, 1)}
+
+
+def _mapas(datos: dict) -> dict:
+    # Llaves subrogadas ficticias: id natural + desplazamiento
+    return {
+        'dim_sede': pd.Series(datos['sede']['sede_id'].to_numpy() + 1000, index=datos['sede']['sede_id'].to_numpy()),
+        'dim_cliente': pd.Series(datos['cliente']['cliente_id'].to_numpy() + 2000, index=datos['cliente']['cliente_id'].to_numpy()),
+        'dim_mensajero': pd.Series(datos['clientes_mensajeroaquitoy']['id'].to_numpy() + 3000,
+                                   index=datos['clientes_mensajeroaquitoy']['id'].to_numpy()),
+    }
+
+
+def _segundos(horas: pd.Series) -> pd.Series:
+    # datetime.time -> segundos desde la medianoche, como los entrega el extract (ver 'segundos' en EXTRACT_SPEC)
+    return pd.Series([None if h is None else h.hour * 3600 + h.minute * 60 + h.second + h.microsecond / 1e6
+                      for h in horas], index=horas.index, dtype='float64')
+
+
+def como_extraido(datos: dict) -> dict:
+    """
+    :param datos: tablas sinteticas (ver generador.generar)
+    :return: las mismas tablas con las columnas de hora en segundos, como quedan despues del extract
+    """
+    extraidos = dict(datos)
+    for tname, col in (('mensajeria_servicio', 'hora_solicitud'), ('mensajeria_estadosservicio', 'hora')):
+        extraidos[tname] = datos[tname].assign(**{col: _segundos(datos[tname][col])})
+    return extraidos
+
+
+def _tablas_hecho(datos: dict) -> list:
+    # Copias porque transform_hecho_servicios modifica el frame de servicios
+    return [datos[t].copy() for t in ('mensajeria_servicio', 'clientes_usuarioaquitoy',
+                                      'mensajeria_estadosservicio', 'mensajeria_novedadesservicio')]
+
+
+def poblar_oltp(datos: dict, url: str):
+    """
+    :param datos: tablas sinteticas (ver generador.generar)
+    :param url: url de la base de datos de prueba
+    :return: void, escribe las tablas; sqlite no tiene tipo time, las horas se guardan ya en segundos
+        (lo que devuelve extract(epoch from hora) en PostgreSQL)
+    """
+    conn = create_engine(url)
+    for tname, tabla in como_extraido(datos).items():
+        tabla.to_sql(tname, conn, if_exists='replace', index=False, chunksize=50_000)
+    conn.dispose()
+
+
+def preparar_olap(datos: dict, url: str):
+    """
+    :param datos: tablas sinteticas (ver generador.generar)
+    :param url: url de la base de datos de prueba
+    :return: void, crea el esquema y carga las dimensiones de cliente, mensajero y sede
+    """
+    conn = create_engine(url)
+    with conn.connect() as con:
+        for script in ESQUEMA_OLAP:
+            con.execute(text(script))
+        con.commit()
+    with contextlib.redirect_stdout(io.StringIO()):
+        dimensiones = {
+            'dim_mensajero': transform.transform_mensajero([datos['clientes_mensajeroaquitoy'], datos['auth_user']]),
+            'dim_cliente': transform.transform_cliente([datos['cliente']]),
+            'dim_sede': transform.transform_sede([datos['sede'], datos['ciudad']]),
+        }
+    for tname, dim in dimensiones.items():
+        dim.to_sql(tname, conn, if_exists='append', index=False)
+    conn.dispose()
+
+
+def ejecutar(servicios: int, chunk_size: int = None, memoria: bool = True) -> list:
+    """
+    :param servicios: escala de mensajeria_servicio
+    :param chunk_size: CHUNK_SIZE de la prueba de punta a punta
+    :param memoria: medir memoria pico por etapa
+    :return: resultados por etapa
+    """
+    metrics.configurar(None)
+    datos = generar(servicios)
+    mapas = _mapas(datos)
+    # Las etapas en memoria reciben las tablas como las deja el extract
+    extraidos = como_extraido(datos)
+    resultados = []
+
+    resultados.append(medir('transform_tiempo', lambda: transform.transform_tiempo([datos['mensajeria_servicio']]), memoria))
+    resultados.append(medir('agregar_eventos', lambda: transform.agregar_eventos(
+        extraidos['mensajeria_estadosservicio'], extraidos['mensajeria_novedadesservicio']), memoria))
+    resultados.append(medir('transform_hecho_servicios', lambda: transform.transform_hecho_servicios(
+        _tablas_hecho(extraidos), mapas), memoria))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        hecho = transform.transform_hecho_servicios(_tablas_hecho(extraidos), mapas)
+    # Entrada de clean con una parte de las filas sin llaves ni tiempos
+    sucio = pd.concat([hecho, hecho.sample(frac=0.2, random_state=0).assign(key_dim_sede=None, tiempo_total_espera=None)])
+    resultados.append(medir('clean_hecho_servicios', lambda: transform.clean_hecho_servicios(sucio), memoria))
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        url_olap = f"sqlite:///{os.path.join(carpeta, 'olap.db')}"
+        url_oltp = f"sqlite:///{os.path.join(carpeta, 'oltp.db')}"
+        poblar_oltp(datos, url_oltp)
+
+        olap_carga = create_engine(url_olap)
+
+        def tabla_carga_vacia():
+            with olap_carga.begin() as con:
+                con.execute(text('drop table if exists hecho_servicios_bench'))
+
+        resultados.append(medir('load', lambda: load.load(hecho, olap_carga, 'hecho_servicios_bench'), memoria,
+                                preparar=tabla_carga_vacia))
+        olap_carga.dispose()
+
+        with open('config.yml', 'r') as f:
+            config = yaml.safe_load(f)
+        config.update(INCREMENTAL=False, ELT_AGGREGATES=False, LOAD_METHOD={}, PARALLEL_WORKERS=1,
+                      EXTRACT_WORKERS=1, CHUNK_SIZE=chunk_size, LOOKUP_CACHE_DIR=os.path.join(carpeta, 'cache'))
+        # Las horas ya estan en segundos en sqlite, el extract(epoch) es solo de PostgreSQL
+        for spec_tabla in config['EXTRACT_SPEC'].values():
+            spec_tabla.pop('segundos', None)
+        oltp_conn, olap_conn = create_engine(url_oltp), create_engine(url_olap)
+
+        def olap_nuevo():
+            # Cada pasada carga en un archivo OLAP nuevo, solo con el esquema y las dimensiones
+            olap_conn.dispose()
+            if os.path.exists(os.path.join(carpeta, 'olap.db')):
+                os.remove(os.path.join(carpeta, 'olap.db'))
+            for tname in lookup.DIMENSIONES:
+                lookup.invalidar(tname, config['LOOKUP_CACHE_DIR'])
+            preparar_olap(datos, url_olap)
+
+        resultados.append(medir('pipeline_punta_a_punta', lambda: pipeline.cargar_hechos(oltp_conn, olap_conn, config),
+                                memoria, preparar=olap_nuevo))
+        oltp_conn.dispose()
+        olap_conn.dispose()
+    return resultados
+
+
+def comparar(resultados: list, baseline: dict) -> pd.DataFrame:
+    """
+    :param resultados: resultados de la ejecucion actual
+    :param baseline: resultados guardados de la misma escala, etapa -> resultado
+    :return: tabla con el cambio porcentual de tiempo y memoria frente al baseline
+    """
+    tabla = pd.DataFrame(resultados).set_index('etapa')
+    if not baseline:
+        return tabla
+    base = pd.DataFrame(baseline.values(), index=list(baseline.keys())).reindex(tabla.index)
+    tabla['tiempo_base_s'] = base['tiempo_s']
+    tabla['cambio_tiempo_%'] = ((tabla['tiempo_s'] / base['tiempo_s'] - 1) * 100).round(1)
+    tabla['memoria_base_mb'] = base['memoria_mb']
+    tabla['cambio_memoria_%'] = ((tabla['memoria_mb'] / base['memoria_mb'] - 1) * 100).round(1)
+    return tabla
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del ETL con datos sinteticos')
+    parser.add_argument('--servicios', type=int, default=10_000, help='filas de mensajeria_servicio (10k a 10M)')
+    parser.add_argument('--chunk-size', type=int, default=None, help='CHUNK_SIZE de la prueba de punta a punta')
+    parser.add_argument('--sin-memoria', action='store_true', help='no medir memoria pico (mas rapido)')
+    parser.add_argument('--baseline', default=BASELINE, help='archivo JSON con los resultados de referencia')
+    parser.add_argument('--guardar-baseline', action='store_true', help='guardar esta ejecucion como referencia')
+    parser.add_argument('--umbral', type=float, default=10.0, help='porcentaje de aumento que se reporta como regresion')
+    args = parser.parse_args()
+
+    resultados = ejecutar(args.servicios, args.chunk_size, memoria=not args.sin_memoria)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baselines = json.load(f)
+    escala = str(args.servicios)
+    tabla = comparar(resultados, baselines.get(escala))
+    print(f'=== BENCHMARK ETL: {args.servicios} servicios ===')
+    print(tabla.to_string())
+
+    if 'cambio_tiempo_%' in tabla:
+        regresiones = tabla[(tabla['cambio_tiempo_%'] > args.umbral) | (tabla['cambio_memoria_%'] > args.umbral)]
+        for etapa in regresiones.index:
+            print(f'REGRESION en {etapa}: tiempo {regresiones.loc[etapa, "cambio_tiempo_%"]}%, '
+                  f'memoria {regresiones.loc[etapa, "cambio_memoria_%"]}%')
+    else:
+        print(f'Sin baseline para {escala} servicios en {args.baseline}')
+
+    if args.guardar_baseline:
+        baselines[escala] = {r['etapa']: {'tiempo_s': r['tiempo_s'], 'memoria_mb': r['memoria_mb']} for r in resultados}
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f'Baseline guardado en {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import json
+import os
+import shutil
+import zlib
+from datetime import datetime
+
+import pandas as pd
+
+# Carpeta local de checkpoints, una subcarpeta por ejecucion
+CHECKPOINT_DIR = '.checkpoints'
+MANIFIESTO = 'manifiesto.json'
+
+_directorio = None
+_formato = 'parquet'
+_manifiesto = None
+
+
+def _ruta_run(directorio: str, run_id: str) -> str:
+    return os.path.join(directorio, run_id)
+
+
+def _leer_manifiesto(ruta: str) -> dict:
+    with open(os.path.join(ruta, MANIFIESTO)) as f:
+        return json.load(f)
+
+
+def _escribir_manifiesto():
+    ruta = _ruta_run(_directorio, _manifiesto['run_id'])
+    temporal = os.path.join(ruta, MANIFIESTO + '.tmp')
+    with open(temporal, 'w') as f:
+        json.dump(_manifiesto, f, indent=2, default=str)
+    # El reemplazo es atomico, una caida no deja el manifiesto a medias
+    os.replace(temporal, os.path.join(ruta, MANIFIESTO))
+
+
+def ejecuciones(directorio: str = CHECKPOINT_DIR) -> list[dict]:
+    """
+    :param directorio: carpeta de checkpoints
+    :return: manifiestos de las ejecuciones guardadas, de la mas antigua a la mas reciente
+    """
+    if not os.path.isdir(directorio):
+        return []
+    manifiestos = [_leer_manifiesto(os.path.join(directorio, nombre)) for nombre in os.listdir(directorio)
+                   if os.path.exists(os.path.join(directorio, nombre, MANIFIESTO))]
+    return sorted(manifiestos, key=lambda m: m['creado'])
+
+
+def _depurar(directorio: str, conservar: int):
+    # Se conservan las ultimas ejecuciones, incluida la actual
+    for manifiesto in ejecuciones(directorio)[:-conservar]:
+        print(f"Borrando checkpoints de la ejecucion {manifiesto['run_id']}")
+        shutil.rmtree(_ruta_run(directorio, manifiesto['run_id']), ignore_errors=True)
+
+
+def _retomable(manifiesto: dict, watermark) -> bool:
+    # El watermark avanza lote a lote durante la ejecucion; se retoma mientras no haya retrocedido
+    # respecto al watermark con el que arranco (los lotes ya cargados quedan por debajo del actual)
+    if manifiesto['completo']:
+        return False
+    if manifiesto['watermark'] is None:
+        return True
+    return watermark is not None and watermark >= manifiesto['watermark']
+
+
+def iniciar(config_checkpoint: dict, run_id: str, watermark=None, reanudar: bool = False) -> str:
+    """
+    :param config_checkpoint: configuracion de checkpoints (CHECKPOINT en config.yml); None o activo False los desactiva
+    :param run_id: identificador de la ejecucion actual
+    :param watermark: watermark del origen con el que arranca la ejecucion
+    :param reanudar: retoma la ejecucion mas reciente si quedo sin terminar y su watermark inicial no supera el actual
+    :return: run_id de la ejecucion cuyos checkpoints se usan, None si estan desactivados
+    """
+    global _directorio, _formato, _manifiesto
+    _manifiesto = None
+    if not config_checkpoint or not config_checkpoint.get('activo', True):
+        return None
+    _directorio = config_checkpoint.get('dir', CHECKPOINT_DIR)
+    _formato = config_checkpoint.get('formato', 'parquet')
+
+    if reanudar:
+        # Solo la ejecucion mas reciente: si otra posterior ya termino, sus dimensiones y lotes son mas nuevos
+        # que los checkpoints de la ejecucion fallida y reanudarla los sobrescribiria con datos viejos
+        recientes = ejecuciones(_directorio)[-1:]
+        if recientes and _retomable(recientes[0], watermark):
+            _manifiesto = recientes[0]
+            print(f"Reanudando la ejecucion {_manifiesto['run_id']} (watermark inicial {_manifiesto['watermark']}, "
+                  f"actual {watermark}) desde sus checkpoints")
+            return _manifiesto['run_id']
+        print(f"La ultima ejecucion no quedo sin terminar o no se puede retomar con watermark {watermark}, "
+              f"se inicia una nueva")
+
+    _manifiesto = {'run_id': run_id, 'watermark': watermark, 'creado': datetime.now().isoformat(),
+                   'formato': _formato, 'completo': False, 'lotes': {}}
+    os.makedirs(_ruta_run(_directorio, run_id), exist_ok=True)
+    _escribir_manifiesto()
+    _depurar(_directorio, config_checkpoint.get('conservar', 3))
+    return run_id
+
+
+def abrir(directorio: str = CHECKPOINT_DIR, run_id: str = None) -> dict:
+    """
+    :param directorio: carpeta de checkpoints
+    :param run_id: ejecucion a abrir, por defecto la mas reciente con extracciones guardadas
+    :return: manifiesto de la ejecucion, queda como la ejecucion actual para leer y guardar checkpoints
+    """
+    global _directorio, _formato, _manifiesto
+    if run_id is not None:
+        manifiesto = _leer_manifiesto(_ruta_run(directorio, run_id))
+    else:
+        con_extract = [m for m in ejecuciones(directorio)
+                       if any(lote.get('extract') for lote in m['lotes'].values())]
+        if not con_extract:
+            raise FileNotFoundError(f'No hay extracciones guardadas en {directorio}')
+        manifiesto = con_extract[-1]
+    _directorio, _formato, _manifiesto = directorio, manifiesto['formato'], manifiesto
+    return manifiesto
+
+
+def activo() -> bool:
+    return _manifiesto is not None
+
+
+def lote(desde=None, hasta=None, servicios: list = None) -> str:
+    """
+    :return: nombre del lote del hecho para el rango de ids (desde, hasta] o para una lista de servicios
+    """
+    if servicios is not None:
+        # La misma lista de servicios a recalcular da el mismo nombre en una ejecucion reanudada
+        return f'recalculo_{len(servicios)}_{zlib.crc32(str(list(servicios)).encode()):08x}'
+    return f'hecho_{desde}_{hasta}'
+
+
+def lotes() -> list[str]:
+    return list(_manifiesto['lotes']) if activo() else []
+
+
+def etapa(nombre_lote: str) -> str:
+    """
+    :param nombre_lote: lote (rango de ids del hecho o 'dimensiones')
+    :return: ultima etapa completada del lote, None si no tiene ninguna
+    """
+    if not activo():
+        return None
+    return _manifiesto['lotes'].get(nombre_lote, {}).get('etapa')
+
+
+def guardar(nombre_lote: str, etapa_lote: str, tablas: dict):
+    """
+    :param nombre_lote: lote al que pertenecen las tablas
+    :param etapa_lote: etapa que produjo las tablas
+    :param tablas: nombre -> DataFrame, se escriben en formato columnar con un indice por defecto
+    :return: void, reemplaza lo guardado antes por la etapa; no se da por completada hasta llamar a completar
+    """
+    if not activo():
+        return
+    ruta = _ruta_run(_directorio, _manifiesto['run_id'])
+    for nombre, tabla in tablas.items():
+        archivo = os.path.join(ruta, f'{nombre_lote}.{etapa_lote}.{nombre}.{_formato}')
+        tabla = tabla.reset_index(drop=True)
+        if _formato == 'feather':
+            tabla.to_feather(archivo)
+        else:
+            tabla.to_parquet(archivo, index=False)
+    registro = _manifiesto['lotes'].setdefault(nombre_lote, {'etapa': None})
+    registro[etapa_lote] = list(tablas)
+    if etapa_lote == 'transform':
+        # Una transformacion nueva se carga completa
+        registro['cargadas'] = []
+    _escribir_manifiesto()
+
+
+def completar(nombre_lote: str, etapa_lote: str):
+    """
+    :param nombre_lote: lote
+    :param etapa_lote: etapa que termino, las siguientes ejecuciones con --resume la saltan
+    :return: void
+    """
+    if not activo():
+        return
+    _manifiesto['lotes'].setdefault(nombre_lote, {})['etapa'] = etapa_lote
+    _escribir_manifiesto()
+
+
+def registrar_carga(nombre_lote: str, nombre: str):
+    """
+    :param nombre_lote: lote
+    :param nombre: tabla transformada del lote que ya quedo cargada en el OLAP
+    :return: void
+    """
+    if not activo():
+        return
+    _manifiesto['lotes'][nombre_lote].setdefault('cargadas', []).append(nombre)
+    _escribir_manifiesto()
+
+
+def cargadas(nombre_lote: str) -> list[str]:
+    """
+    :param nombre_lote: lote
+    :return: tablas transformadas del lote que ya se cargaron
+    """
+    if not activo():
+        return []
+    return _manifiesto['lotes'].get(nombre_lote, {}).get('cargadas', [])
+
+
+def leer(nombre_lote: str, etapa_lote: str) -> dict:
+    """
+    :param nombre_lote: lote
+    :param etapa_lote: etapa cuyas tablas se quieren
+    :return: nombre -> DataFrame guardados por la etapa, en el orden en que se guardaron
+    """
+    ruta = _ruta_run(_directorio, _manifiesto['run_id'])
+    tablas = {}
+    for nombre in _manifiesto['lotes'][nombre_lote].get(etapa_lote, []):
+        archivo = os.path.join(ruta, f'{nombre_lote}.{etapa_lote}.{nombre}.{_formato}')
+        tablas[nombre] = pd.read_feather(archivo) if _formato == 'feather' else pd.read_parquet(archivo)
+    return tablas
+
+
+def finalizar():
+    """
+    :return: void, marca la ejecucion actual como terminada; --resume ya no la retoma
+    """
+    if not activo():
+        return
+    _manifiesto['completo'] = True
+    _escribir_manifiesto()
@@ -1,15 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+from sqlalchemy import Float, cast, column, extract as sql_extract, func, select, table, text
 from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+
+from etl import metrics
+from etl.transform import COLUMNAS_EVENTOS, ESTADOS_SERVICIO, TIPOS_NOVEDAD
+
+
+def build_query(tname: str, spec: dict = None, condiciones: tuple = ()) -> Select:
+    """
+    Construye el SELECT de una tabla a partir de la especificacion declarativa de extraccion.
+
+    :param tname: tabla a extraer
+    :param spec: especificacion por tabla, {tabla: {'columns': [...], 'where': {columna: valor o lista},
+        'parse_dates': [...], 'dtype': {columna: tipo}, 'segundos': [...]}}
+    :param condiciones: condiciones sqlalchemy adicionales (rangos de ids, subconsultas)
+    :return: consulta sqlalchemy con la proyeccion y los filtros de la tabla
+    """
+    spec_tabla = (spec or {}).get(tname) or {}
+    columnas = spec_tabla.get('columns')
+    segundos = set(spec_tabla.get('segundos') or [])
+    tabla = table(tname, *[column(c) for c in columnas or []])
+    # Las columnas time llegan como segundos desde la medianoche, pandas las convierte sin parsear texto
+    proyeccion = [cast(sql_extract('epoch', c), Float).label(c.name) if c.name in segundos else c for c in tabla.columns]
+    query = select(*proyeccion) if columnas else select(text('*')).select_from(tabla)
+
+    for col, valor in (spec_tabla.get('where') or {}).items():
+        if isinstance(valor, (list, tuple)):
+            query = query.where(column(col).in_(valor))
+        else:
+            query = query.where(column(col) == valor)
+    for condicion in condiciones:
+        query = query.where(condicion)
+    return query
+
+
+def _rango(col: str, desde=None, hasta=None) -> tuple:
+    # Condiciones del rango de ids (desde, hasta] sobre la columna col
+    condiciones = []
+    if desde is not None:
+        condiciones.append(column(col) > int(desde))
+    if hasta is not None:
+        condiciones.append(column(col) <= int(hasta))
+    return tuple(condiciones)
 
 
-def extract(tables : list, conection: Engine)-> pd.DataFrame:
+def _filtro_servicios(col: str, desde=None, hasta=None, servicios: list = None) -> tuple:
+    # Rango de ids (desde, hasta] y, si se indica, solo los servicios de la lista
+    condiciones = _rango(col, desde, hasta)
+    if servicios is not None:
+        condiciones += (column(col).in_([int(s) for s in servicios]),)
+    return condiciones
+
+
+def _read(tname: str, conection: Engine, spec: dict = None, condiciones: tuple = ()) -> pd.DataFrame:
+    spec_tabla = (spec or {}).get(tname) or {}
+    return pd.read_sql(build_query(tname, spec, condiciones), conection,
+                       parse_dates=spec_tabla.get('parse_dates'), dtype=spec_tabla.get('dtype'))
+
+
+def ejecutar_concurrente(tareas: dict, workers: int = 1) -> dict:
+    """
+    Ejecuta lecturas independientes en un pool de hilos; pueden ir contra engines distintos.
+
+    :param tareas: nombre -> funcion sin argumentos que hace la lectura
+    :param workers: hilos del pool, 1 ejecuta las tareas una tras otra
+    :return: nombre -> resultado de la tarea
+    """
+    if workers <= 1 or len(tareas) <= 1:
+        return {nombre: tarea() for nombre, tarea in tareas.items()}
+    with ThreadPoolExecutor(max_workers=min(workers, len(tareas))) as pool:
+        futuros = {nombre: pool.submit(tarea) for nombre, tarea in tareas.items()}
+        return {nombre: futuro.result() for nombre, futuro in futuros.items()}
+
+
+@metrics.instrumentar('extract')
+def extract(tables : list, conection: Engine, spec: dict = None, workers: int = 1)-> pd.DataFrame:
     """
     :param conection: the conectionnection to the database
     :param tables: the tables to extract
+    :param spec: columnas y filtros por tabla (ver build_query); las tablas sin spec se leen completas
+    :param workers: tablas que se leen a la vez
     :return: a list of tables in df format
     """
-    a = []
-    for i in tables:
-        aux = pd.read_sql_table(i, conection)
-        a.append(aux)
-    return a
\ No newline at end of file
+    def leer(i):
+        if spec and i in spec:
+            return lambda: _read(i, conection, spec)
+        return lambda: pd.read_sql_table(i, conection)
+
+    resultado = ejecutar_concurrente({i: leer(i) for i in tables}, workers)
+    return [resultado[i] for i in tables]
+
+
+@metrics.instrumentar('extract')
+def extract_incremental(conection: Engine, desde=None, hasta=None, spec: dict = None, eventos: bool = True,
+                        workers: int = 1, servicios: list = None) -> list:
+    """
+    Extrae solo los servicios con id en el rango (desde, hasta] junto con sus
+    estados, novedades y los usuarios que los solicitaron.
+
+    :param conection: sqlalchemy engine de la base de datos OLTP
+    :param desde: watermark, ultimo id de servicio ya procesado (None extrae desde el inicio)
+    :param hasta: ultimo id de servicio a incluir (None extrae hasta el final)
+    :param spec: columnas y filtros por tabla (ver build_query)
+    :param eventos: si es False no se extraen estados ni novedades (se agregan en el OLTP)
+    :param workers: tablas que se leen a la vez
+    :param servicios: ids de servicio a extraer dentro del rango (None extrae todo el rango)
+    :return: [servicio, cliente_usuario, estado_servicio, novedad_servicio] en formato df,
+        o [servicio, cliente_usuario] si eventos es False
+    """
+    filtro_servicio = _filtro_servicios('id', desde, hasta, servicios)
+    filtro_eventos = _filtro_servicios('servicio_id', desde, hasta, servicios)
+    usuarios = select(column('usuario_id')).select_from(table('mensajeria_servicio')).where(*filtro_servicio)
+
+    tareas = {
+        'mensajeria_servicio': lambda: _read('mensajeria_servicio', conection, spec, filtro_servicio),
+        'clientes_usuarioaquitoy': lambda: _read('clientes_usuarioaquitoy', conection, spec, (column('id').in_(usuarios),)),
+    }
+    if eventos:
+        tareas['mensajeria_estadosservicio'] = lambda: _read('mensajeria_estadosservicio', conection, spec,
+                                                             filtro_eventos)
+        tareas['mensajeria_novedadesservicio'] = lambda: _read('mensajeria_novedadesservicio', conection, spec,
+                                                               filtro_eventos)
+    resultado = list(ejecutar_concurrente(tareas, workers).values())
+
+    if servicios is None:
+        print(f'Extraidos {len(resultado[0])} servicios nuevos (id > {desde})')
+    else:
+        print(f'Extraidos {len(resultado[0])} servicios con eventos tardios')
+    return resultado
+
+
+@metrics.instrumentar('extract')
+def extract_servicios_afectados(conection: Engine, tname: str, desde=None, hasta=None, servicio_hasta=None,
+                                spec: dict = None) -> pd.Series:
+    """
+    Captura de cambios de una tabla de eventos: servicios ya cargados que recibieron
+    estados o novedades nuevos despues de su carga.
+
+    :param conection: sqlalchemy engine de la base de datos OLTP
+    :param tname: tabla de eventos (mensajeria_estadosservicio o mensajeria_novedadesservicio)
+    :param desde: watermark de la tabla, ultimo id de evento ya procesado
+    :param hasta: ultimo id de evento a revisar
+    :param servicio_hasta: watermark de mensajeria_servicio, los servicios posteriores se cargan como nuevos
+    :param spec: columnas y filtros por tabla (ver build_query), se usan los filtros de la tabla de eventos
+    :return: ids unicos de los servicios afectados
+    """
+    # Solo los filtros de la tabla importan, un evento que el hecho no usa no afecta al servicio
+    spec_ids = {tname: {'columns': ['servicio_id'], 'where': ((spec or {}).get(tname) or {}).get('where')}}
+    condiciones = _rango('id', desde, hasta) + _rango('servicio_id', hasta=servicio_hasta)
+    afectados = pd.read_sql(build_query(tname, spec_ids, condiciones).distinct(), conection)['servicio_id']
+    print(f'{tname}: {len(afectados)} servicios cargados con eventos nuevos (id en ({desde}, {hasta}])')
+    return afectados
+
+
+@metrics.instrumentar('extract')
+def extract_eventos_agregados(conection: Engine, desde=None, hasta=None, servicios: list = None) -> pd.DataFrame:
+    """
+    Calcula en el OLTP la ultima fecha-hora de cada estado y la cantidad de novedades por
+    tipo de cada servicio, trayendo una sola fila por servicio (equivale a transform.agregar_eventos).
+
+    :param conection: sqlalchemy engine de la base de datos OLTP (postgresql)
+    :param desde: ultimo id de servicio ya procesado (None agrega desde el inicio)
+    :param hasta: ultimo id de servicio a incluir (None agrega hasta el final)
+    :param servicios: ids de servicio a agregar dentro del rango (None agrega todo el rango)
+    :return: df indexado por servicio_id con las columnas de transform.COLUMNAS_EVENTOS
+    """
+    # Igual que en pandas, la fecha-hora del estado se trunca a segundos
+    fecha_hora = func.date_trunc('second', column('fecha') + column('hora'))
+    estados = select(
+        column('servicio_id'),
+        *[func.max(fecha_hora).filter(column('estado_id') == estado_id).label(f'estado_{estado_id}_fecha_hora')
+          for estado_id in ESTADOS_SERVICIO]
+    ).select_from(table('mensajeria_estadosservicio'))\
+     .where(column('estado_id').in_(ESTADOS_SERVICIO), *_filtro_servicios('servicio_id', desde, hasta, servicios))\
+     .group_by(column('servicio_id'))\
+     .subquery('e')
+
+    novedades = select(
+        column('servicio_id'),
+        *[func.count().filter(column('tipo_novedad_id') == tipo).label(f'cantidad_novedades_tipo_{tipo}')
+          for tipo in TIPOS_NOVEDAD]
+    ).select_from(table('mensajeria_novedadesservicio'))\
+     .where(column('tipo_novedad_id').in_(TIPOS_NOVEDAD), *_filtro_servicios('servicio_id', desde, hasta, servicios))\
+     .group_by(column('servicio_id'))\
+     .subquery('n')
+
+    query = select(
+        func.coalesce(estados.c.servicio_id, novedades.c.servicio_id).label('servicio_id'),
+        *[c for c in estados.c if c.name != 'servicio_id'],
+        *[c for c in novedades.c if c.name != 'servicio_id'],
+    ).select_from(estados.join(novedades, estados.c.servicio_id == novedades.c.servicio_id, full=True))
+
+    eventos = pd.read_sql(query, conection, parse_dates=COLUMNAS_EVENTOS[:len(ESTADOS_SERVICIO)])
+    print(f'Eventos agregados en el OLTP para {len(eventos)} servicios')
+    return eventos.set_index('servicio_id')
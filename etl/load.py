@@ -1,22 +1,36 @@
+import io
+import time
+
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from sqlalchemy.engine import Engine
-from sqlalchemy import text
+from sqlalchemy import bindparam, text
 import yaml
 from sqlalchemy.dialects.postgresql import insert
 
-def load(table: DataFrame, etl_conn: Engine, tname, replace: bool = False):
+from etl import metrics
+
+# Marca de nulo en el CSV del COPY; un campo vacio se lee como texto vacio y no como NULL
+NULO_CSV = '\\N'
+
+
+@metrics.instrumentar('load')
+def load(table: DataFrame, etl_conn: Engine, tname, replace: bool = False, method: str = 'insert', key: str = None):
     """
 
     :param table: table to load into the database
     :param etl_conn: sqlalchemy engine to connect to the database
     :param tname: table name to load into the database
     :param replace:  when true it deletes existing table data(rows)
+    :param method: 'insert' usa DataFrame.to_sql, 'copy' usa COPY a una tabla staging y luego upsert
+    :param key: columna unica para el ON CONFLICT del metodo 'copy' (sin ella solo inserta)
     :return: void it just load the table to the database
     """
     # statement = insert(f'{table})
     # with etl_conn.connect() as conn:
     #     conn.execute(statement)
+    inicio = time.perf_counter()
     if replace :
         print(f'reemplazando datos de la tabla {tname}')
         with etl_conn.connect() as conn:
@@ -24,7 +38,194 @@ def load(table: DataFrame, etl_conn: Engine, tname, replace: bool = False):
             conn.execute(text(f'Delete from {tname}'))
             conn.commit()
         print(f'insertando los nuevos datos de la tabla {tname}')
-        table.to_sql(f'{tname}', etl_conn, if_exists='append', index=False)
     else :
         print(f'insertando datos de la tabla {tname}')
+
+    table = _intervalos_a_texto(table)
+    if method == 'copy':
+        filas = copy_upsert(table, etl_conn, tname, key)
+    elif method == 'insert':
         table.to_sql(f'{tname}', etl_conn, if_exists='append', index=False)
+        filas = len(table)
+    else:
+        raise ValueError(f'Metodo de carga desconocido: {method}')
+
+    duracion = time.perf_counter() - inicio
+    print(f'{tname}: {filas} filas cargadas en {duracion:.2f} s ({method})')
+
+
+@metrics.instrumentar('load')
+def upsert(table: DataFrame, etl_conn: Engine, tname: str, key: str, method: str = 'insert'):
+    """
+    Reemplaza en la tabla destino las filas cuya llave viene en el DataFrame (recalculos de filas ya cargadas).
+
+    :param table: filas recalculadas
+    :param etl_conn: sqlalchemy engine to connect to the database
+    :param tname: table name to load into the database
+    :param key: columna unica de la tabla destino
+    :param method: 'copy' usa copy_upsert, 'insert' borra las llaves e inserta en la misma transaccion
+    :return: void
+    """
+    inicio = time.perf_counter()
+    table = _intervalos_a_texto(table)
+    if method == 'copy':
+        filas = copy_upsert(table, etl_conn, tname, key)
+    elif method == 'insert':
+        borrar = text(f'delete from {tname} where {key} in :llaves').bindparams(bindparam('llaves', expanding=True))
+        with etl_conn.begin() as conn:
+            conn.execute(borrar, {'llaves': [int(llave) for llave in table[key]]})
+            table.to_sql(f'{tname}', conn, if_exists='append', index=False)
+        filas = len(table)
+    else:
+        raise ValueError(f'Metodo de carga desconocido: {method}')
+
+    duracion = time.perf_counter() - inicio
+    print(f'{tname}: {filas} filas reemplazadas en {duracion:.2f} s ({method})')
+
+
+def copy_upsert(table: DataFrame, etl_conn: Engine, tname: str, key: str = None) -> int:
+    """
+    Carga el DataFrame con COPY en una tabla temporal y la mezcla en la tabla destino
+    con INSERT ... ON CONFLICT (key) DO UPDATE.
+
+    :param table: table to load into the database
+    :param etl_conn: sqlalchemy engine (postgresql/psycopg2) to connect to the database
+    :param tname: table name to load into the database
+    :param key: columna unica de la tabla destino, None inserta sin resolver conflictos
+    :return: numero de filas insertadas o actualizadas
+    """
+    columnas = ', '.join(table.columns)
+    staging = f'staging_{tname}'
+
+    buffer = _to_csv_buffer(table)
+
+    if key is None:
+        merge = f'insert into {tname} ({columnas}) select {columnas} from {staging}'
+    else:
+        actualizaciones = ', '.join(f'{c} = excluded.{c}' for c in table.columns if c != key)
+        merge = (f'insert into {tname} ({columnas}) '
+                 f'select distinct on ({key}) {columnas} from {staging} '
+                 f'on conflict ({key}) do update set {actualizaciones}')
+
+    raw = etl_conn.raw_connection()
+    try:
+        cur = raw.cursor()
+        _copy_to_staging(cur, buffer, tname, staging, columnas)
+        cur.execute(merge)
+        filas = cur.rowcount
+        cur.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+    return filas
+
+
+def _intervalos_a_texto(table: DataFrame) -> DataFrame:
+    """
+    Convierte las columnas timedelta en texto de interval de PostgreSQL ('N seconds'), nulos como None.
+    to_sql escribiria los timedelta como enteros de nanosegundos. Los tiempos del hecho son segundos
+    enteros (ver transform._hora_a_timedelta); el texto se arma con numpy sobre los segundos enteros.
+    """
+    intervalos = table.select_dtypes('timedelta').columns
+    if intervalos.empty:
+        return table
+    table = table.copy()
+    for col in intervalos:
+        nulos = table[col].isna().to_numpy()
+        segundos = table[col].to_numpy().astype('timedelta64[s]').astype('int64')
+        texto = np.char.add(segundos.astype('U'), ' seconds').astype(object)
+        texto[nulos] = None
+        table[col] = pd.Series(texto, index=table.index, dtype=object)
+    return table
+
+
+def _to_csv_buffer(table: DataFrame) -> io.StringIO:
+    # convert_dtypes evita que las llaves enteras con nulos se serialicen como '1.0'
+    buffer = io.StringIO()
+    table.convert_dtypes().to_csv(buffer, index=False, header=False, na_rep=NULO_CSV)
+    buffer.seek(0)
+    return buffer
+
+
+def _copy_to_staging(cur, buffer: io.StringIO, tname: str, staging: str, columnas: str):
+    """
+    Crea una tabla temporal con las columnas de la tabla destino y la llena con COPY.
+
+    :param cur: cursor psycopg2 abierto
+    :param buffer: CSV en memoria con los datos
+    :param tname: tabla destino de la que se copian los tipos de las columnas
+    :param staging: nombre de la tabla temporal
+    :param columnas: columnas separadas por coma, en el orden del CSV
+    """
+    cur.execute(f'create temp table {staging} on commit drop as '
+                f'select {columnas} from {tname} with no data')
+    cur.copy_expert(f"copy {staging} ({columnas}) from stdin with (format csv, null '{NULO_CSV}')", buffer)
+
+
+def _row_hash(table: DataFrame, columnas: list) -> pd.Series:
+    # Se normaliza a texto para que None/NaN y los tipos leidos de la base hasheen igual
+    return pd.util.hash_pandas_object(table[columnas].astype('string'), index=False)
+
+
+@metrics.instrumentar('load')
+def merge_dimension(dim: DataFrame, etl_conn: Engine, tname: str, natural_key: str) -> dict:
+    """
+    Sincroniza una dimension con la tabla del OLAP comparando un hash por fila: inserta los ids
+    naturales nuevos, actualiza los que cambiaron y no toca el resto, de modo que las llaves
+    subrogadas existentes no cambian.
+
+    :param dim: dimension transformada (id natural + atributos, sin llave subrogada)
+    :param etl_conn: sqlalchemy engine (postgresql/psycopg2) to connect to the database
+    :param tname: nombre de la dimension en el OLAP
+    :param natural_key: columna con el id natural de la dimension
+    :return: conteo de filas nuevas, actualizadas y sin cambios
+    """
+    inicio = time.perf_counter()
+    atributos = [c for c in dim.columns if c != natural_key]
+    dim = dim.drop_duplicates(subset=natural_key, keep='last')
+
+    actual = pd.read_sql(text(f'select {natural_key}, {", ".join(atributos)} from {tname}'), etl_conn)
+    actual = actual.drop_duplicates(subset=natural_key, keep='last')
+
+    nuevos = dim[~dim[natural_key].isin(actual[natural_key])]
+
+    comparacion = dim.assign(_hash=_row_hash(dim, atributos).values).merge(
+        actual.assign(_hash_actual=_row_hash(actual, atributos).values)[[natural_key, '_hash_actual']],
+        on=natural_key, how='inner'
+    )
+    cambiados = comparacion.loc[comparacion['_hash'] != comparacion['_hash_actual'], dim.columns]
+
+    if len(nuevos):
+        nuevos.to_sql(tname, etl_conn, if_exists='append', index=False)
+
+    if len(cambiados):
+        columnas = ', '.join(cambiados.columns)
+        staging = f'staging_{tname}'
+        buffer = _to_csv_buffer(cambiados)
+        asignaciones = ', '.join(f'{c} = s.{c}' for c in atributos)
+        raw = etl_conn.raw_connection()
+        try:
+            cur = raw.cursor()
+            _copy_to_staging(cur, buffer, tname, staging, columnas)
+            cur.execute(f'update {tname} t set {asignaciones} from {staging} s '
+                        f'where t.{natural_key} = s.{natural_key}')
+            cur.close()
+            raw.commit()
+        except Exception:
+            raw.rollback()
+            raise
+        finally:
+            raw.close()
+
+    resultado = {
+        'nuevos': len(nuevos),
+        'actualizados': len(cambiados),
+        'sin_cambios': len(comparacion) - len(cambiados),
+    }
+    duracion = time.perf_counter() - inicio
+    print(f'{tname}: {resultado["nuevos"]} nuevos, {resultado["actualizados"]} actualizados, '
+          f'{resultado["sin_cambios"]} sin cambios en {duracion:.2f} s')
+    return resultado
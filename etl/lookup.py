@@ -0,0 +1,109 @@
+import os
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# Dimensiones con llave subrogada: tabla -> (id natural, llave subrogada)
+DIMENSIONES = {
+    'dim_sede': ('id_sede', 'key_dim_sede'),
+    'dim_cliente': ('id_cliente', 'key_dim_cliente'),
+    'dim_mensajero': ('id_mensajero', 'key_dim_mensajero'),
+}
+
+# Carpeta local donde se guardan los mapas entre ejecuciones
+CACHE_DIR = '.cache_llaves'
+
+
+# Mapas ya leidos en este proceso, un proceso de larga duracion no vuelve a leer el pickle
+_memoria = {}
+
+
+def _ruta(tname: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, f'{tname}.pkl')
+
+
+def _leer_cache(ruta: str) -> tuple:
+    # El pickle guarda el mapa con la huella de la dimension al momento de leerlo
+    guardado = pd.read_pickle(ruta)
+    if isinstance(guardado, pd.Series):
+        # Cache de una version anterior, sin huella
+        return None, guardado
+    return guardado['huella'], guardado['mapa']
+
+
+def huella(conn_olap: Engine, tname: str) -> tuple:
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param tname: dimension
+    :return: (filas, llave maxima) de la dimension; cambia cuando se agregan, borran o recargan filas
+    """
+    _, llave = DIMENSIONES[tname]
+    with conn_olap.connect() as con:
+        filas, maxima = con.execute(text(f'select count(*), max({llave}) from {tname}')).fetchone()
+    return int(filas), None if maxima is None else int(maxima)
+
+
+def cargar_mapa(conn_olap: Engine, tname: str, cache_dir: str = CACHE_DIR) -> pd.Series:
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param tname: dimension de la que se quiere el mapa
+    :param cache_dir: carpeta del cache local
+    :return: Serie indexada por el id natural con la llave subrogada como valor; el cache solo se usa
+        si su huella coincide con la de la dimension en el OLAP
+    """
+    ruta = _ruta(tname, cache_dir)
+    huella_actual = huella(conn_olap, tname)
+    if ruta in _memoria and _memoria[ruta][0] == huella_actual:
+        return _memoria[ruta][1]
+    if os.path.exists(ruta):
+        huella_guardada, mapa = _leer_cache(ruta)
+        if huella_guardada == huella_actual:
+            _memoria[ruta] = (huella_actual, mapa)
+            return mapa
+        print(f'El mapa de llaves de {tname} en cache no coincide con el OLAP {huella_guardada} != {huella_actual}')
+
+    natural, llave = DIMENSIONES[tname]
+    print(f'Cargando mapa de llaves de {tname} desde el OLAP')
+    tabla = pd.read_sql(text(f'select {natural}, {llave} from {tname}'), conn_olap)
+    mapa = pd.Series(tabla[llave].to_numpy(dtype='int32'), index=tabla[natural].to_numpy(), name=llave)
+    # Si un id natural quedo repetido se usa la llave mas reciente
+    mapa = mapa[~mapa.index.duplicated(keep='last')]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    pd.to_pickle({'huella': huella_actual, 'mapa': mapa}, ruta)
+    _memoria[ruta] = (huella_actual, mapa)
+    return mapa
+
+
+def cargar_mapas(conn_olap: Engine, cache_dir: str = CACHE_DIR) -> dict:
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param cache_dir: carpeta del cache local
+    :return: diccionario dimension -> mapa id natural -> llave subrogada
+    """
+    return {tname: cargar_mapa(conn_olap, tname, cache_dir) for tname in DIMENSIONES}
+
+
+def cargar_mapas_cache(cache_dir: str = CACHE_DIR) -> dict:
+    """
+    :param cache_dir: carpeta del cache local
+    :return: diccionario dimension -> mapa id natural -> llave subrogada, solo desde el cache sin consultar el OLAP
+    """
+    faltantes = [tname for tname in DIMENSIONES if not os.path.exists(_ruta(tname, cache_dir))]
+    if faltantes:
+        raise FileNotFoundError(f'No hay mapas de llaves en cache para {faltantes} en {cache_dir}')
+    return {tname: _leer_cache(_ruta(tname, cache_dir))[1] for tname in DIMENSIONES}
+
+
+def invalidar(tname: str, cache_dir: str = CACHE_DIR):
+    """
+    :param tname: dimension cuyo mapa ya no es valido
+    :param cache_dir: carpeta del cache local
+    :return: void, borra el mapa guardado para que se recargue en la siguiente lectura
+    """
+    ruta = _ruta(tname, cache_dir)
+    _memoria.pop(ruta, None)
+    if os.path.exists(ruta):
+        print(f'Invalidando mapa de llaves de {tname}')
+        os.remove(ruta)
@@ -0,0 +1,160 @@
+import functools
+import json
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+try:
+    import resource
+except ImportError:  # Windows: sin medicion de memoria pico
+    resource = None
+
+# Tabla del OLAP con el historial de metricas de cada ejecucion
+TABLA_HISTORIAL = 'etl_run_history'
+# Columnas agregadas al historial despues de su creacion, se agregan a las tablas existentes al guardar
+COLUMNAS_AGREGADAS = {'estado': 'varchar(10)', 'error': 'text'}
+# Largo maximo del mensaje de error guardado por etapa
+LARGO_ERROR = 2000
+
+RUN_ID = uuid.uuid4().hex
+_destino = 'stdout'
+_registros = []
+_lock = threading.Lock()
+
+
+def configurar(destino: str = 'stdout', run_id: str = None):
+    """
+    :param destino: 'stdout', ruta de un archivo de lineas JSON, o None para no emitir
+    :param run_id: identificador de la ejecucion, por defecto uno aleatorio
+    :return: void
+    """
+    global _destino, RUN_ID
+    _destino = destino
+    if run_id is not None:
+        RUN_ID = run_id
+
+
+def _filas(valor):
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        return len(valor)
+    if isinstance(valor, (list, tuple)) and valor and all(isinstance(v, pd.DataFrame) for v in valor):
+        return sum(len(v) for v in valor)
+    return None
+
+
+def _bytes(valor):
+    if isinstance(valor, pd.DataFrame):
+        return int(valor.memory_usage(deep=True).sum())
+    if isinstance(valor, (list, tuple)) and valor and all(isinstance(v, pd.DataFrame) for v in valor):
+        return sum(int(v.memory_usage(deep=True).sum()) for v in valor)
+    return None
+
+
+def _memoria_pico_kb():
+    # ru_maxrss esta en KB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+
+
+def registrar(registro: dict):
+    """
+    :param registro: metricas de una etapa
+    :return: void, emite el registro como linea JSON y lo guarda para el historial
+    """
+    linea = json.dumps(registro, default=str)
+    with _lock:
+        _registros.append(registro)
+        if _destino == 'stdout':
+            print(linea, file=sys.stdout, flush=True)
+        elif _destino:
+            with open(_destino, 'a') as f:
+                f.write(linea + '\n')
+
+
+def instrumentar(etapa: str):
+    """
+    Decorador que mide tiempo, filas de entrada/salida, bytes, delta de memoria pico
+    y filas por segundo de cada llamada a una funcion de extract, transform o load.
+
+    :param etapa: 'extract', 'transform' o 'load'
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            memoria_inicial = _memoria_pico_kb()
+            inicio = datetime.now()
+            t0 = time.perf_counter()
+            resultado = None
+            error = None
+            try:
+                resultado = funcion(*args, **kwargs)
+                return resultado
+            except BaseException as e:
+                # La etapa que falla tambien queda en el historial, con su duracion hasta el error
+                error = e
+                raise
+            finally:
+                duracion = time.perf_counter() - t0
+
+                entradas = [f for f in (_filas(a) for a in list(args) + list(kwargs.values())) if f is not None]
+                filas_entrada = sum(entradas) if entradas else None
+                filas_salida = _filas(resultado)
+                if filas_salida is None and error is None:
+                    # load no devuelve el frame: se cuentan las filas recibidas, o el conteo que devuelva
+                    filas_salida = resultado if isinstance(resultado, int) else filas_entrada
+                datos = resultado if etapa == 'extract' else (args[0] if etapa == 'load' and args else None)
+                memoria_final = _memoria_pico_kb()
+
+                filas = filas_salida if etapa == 'extract' else filas_entrada
+                registrar({
+                    'run_id': RUN_ID,
+                    'etapa': etapa,
+                    'funcion': funcion.__name__,
+                    'inicio': inicio.isoformat(),
+                    'duracion_s': round(duracion, 4),
+                    'filas_entrada': filas_entrada,
+                    'filas_salida': filas_salida,
+                    'bytes': _bytes(datos),
+                    'memoria_pico_delta_kb': None if memoria_inicial is None else memoria_final - memoria_inicial,
+                    'filas_por_s': round(filas / duracion, 1) if filas and duracion > 0 and error is None else None,
+                    'estado': 'ok' if error is None else 'error',
+                    'error': None if error is None else repr(error)[:LARGO_ERROR],
+                })
+        return envoltura
+    return decorador
+
+
+def tomar_registros() -> list[dict]:
+    """
+    :return: metricas acumuladas desde la ultima llamada; se descartan de memoria
+    """
+    with _lock:
+        registros = list(_registros)
+        _registros.clear()
+    return registros
+
+
+def guardar_historial(conn_olap: Engine):
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :return: void, guarda en etl_run_history las metricas acumuladas y las descarta de memoria
+    """
+    registros = tomar_registros()
+    if registros:
+        inspector = inspect(conn_olap)
+        columnas = ({c['name'] for c in inspector.get_columns(TABLA_HISTORIAL)}
+                    if inspector.has_table(TABLA_HISTORIAL) else set())
+        # Un historial creado antes de estado y error recibe las columnas nuevas
+        faltantes = {c: tipo for c, tipo in COLUMNAS_AGREGADAS.items() if columnas and c not in columnas}
+        if faltantes:
+            with conn_olap.begin() as con:
+                for columna, tipo in faltantes.items():
+                    con.execute(text(f'alter table {TABLA_HISTORIAL} add column {columna} {tipo}'))
+        historial = pd.DataFrame(registros)
+        historial['inicio'] = pd.to_datetime(historial['inicio'])
+        historial.to_sql(TABLA_HISTORIAL, conn_olap, if_exists='append', index=False)
@@ -0,0 +1,372 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.engine import Engine
+
+from etl import checkpoint, extract, transform, load, lookup, metrics, rollups, utils_etl
+
+
+def extender_tiempo(olap_conn: Engine, servicio: pd.DataFrame, config: dict, rango_fechas: tuple = None):
+    """
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param servicio: servicios extraidos, se usa su fecha_solicitud
+    :param config: configuracion del ETL (config.yml)
+    :param rango_fechas: (primera, ultima) fecha de dim_tiempo si ya se consulto (ver utils_etl.rango_fechas_tiempo)
+    :return: void, agrega a dim_tiempo solo los dias que faltan para cubrir las fechas de los servicios
+    """
+    primera_fecha, ultima_fecha = rango_fechas or utils_etl.rango_fechas_tiempo(olap_conn)
+    if primera_fecha is None:
+        dim_tiempo = transform.transform_tiempo([servicio])
+    else:
+        partes = []
+        # Dias anteriores al calendario cargado (un lote puede traer fechas mas antiguas)
+        fecha_min = servicio['fecha_solicitud'].min()
+        if fecha_min < pd.Timestamp(primera_fecha):
+            partes.append(transform.transform_tiempo([servicio], desde=fecha_min,
+                                                     hasta=pd.Timestamp(primera_fecha) - pd.Timedelta(days=1)))
+        partes.append(transform.transform_tiempo([servicio], desde=pd.Timestamp(ultima_fecha) + pd.Timedelta(days=1)))
+        dim_tiempo = pd.concat(partes, ignore_index=True)
+    print("total tiempo nuevos: ", len(dim_tiempo))
+    if len(dim_tiempo):
+        load.load(dim_tiempo, etl_conn=olap_conn, tname='dim_tiempo', replace=False,
+                  method=config['LOAD_METHOD'].get('dim_tiempo', 'insert'))
+
+
+# Mapas de llaves de cada proceso del pool, se reciben una sola vez al iniciar el proceso
+_mapas_worker = None
+
+
+def _iniciar_worker(mapas: dict):
+    global _mapas_worker
+    _mapas_worker = mapas
+    # Las metricas del worker no se emiten ni se guardan aqui, vuelven al proceso principal con cada particion
+    metrics.configurar(None)
+    metrics.tomar_registros()
+
+
+def _transformar_particion(tablas: list, eventos: pd.DataFrame = None) -> tuple:
+    try:
+        hecho_servicios = transform.transform_hecho_servicios(tablas, _mapas_worker, eventos=eventos)
+    except Exception as e:
+        # Los atributos de la excepcion viajan con ella al proceso principal, incluida la etapa fallida
+        e.registros_metricas = metrics.tomar_registros()
+        raise
+    return hecho_servicios, metrics.tomar_registros()
+
+
+def _registrar_metricas_worker(registros: list):
+    # Metricas de transform medidas en el worker, con el run id de la ejecucion actual
+    for registro in registros:
+        metrics.registrar({**registro, 'run_id': metrics.RUN_ID})
+
+
+def particionar(tablas: list, eventos: pd.DataFrame = None, particiones: int = 1) -> list:
+    """
+    Divide los datos de un lote en rangos de id de servicio, cada uno con solo sus estados,
+    novedades, usuarios y eventos agregados.
+
+    :param tablas: [servicio, cliente_usuario, estado_servicio, novedad_servicio] o [servicio, cliente_usuario]
+    :param eventos: eventos agregados por servicio (modo ELT) o None
+    :param particiones: cantidad de rangos
+    :return: lista de (tablas, eventos) por rango
+    """
+    servicio, cliente_usuario = tablas[:2]
+    ids = np.sort(servicio['id'].unique())
+    # Limite superior (inclusive) de cada rango
+    limites = [parte[-1] for parte in np.array_split(ids, particiones) if len(parte)]
+
+    def rango(valores: pd.Series) -> np.ndarray:
+        return np.searchsorted(limites, valores.to_numpy(), side='left')
+
+    rango_servicio = rango(servicio['id'])
+    rango_eventos = [rango(tabla['servicio_id']) for tabla in tablas[2:4]]
+    rango_agregados = rango(eventos.index.to_series()) if eventos is not None else None
+
+    resultado = []
+    for i in range(len(limites)):
+        servicio_i = servicio[rango_servicio == i]
+        cliente_usuario_i = cliente_usuario[cliente_usuario['id'].isin(servicio_i['usuario_id'])]
+        tablas_i = [servicio_i, cliente_usuario_i] + [tabla[r == i] for tabla, r in zip(tablas[2:4], rango_eventos)]
+        eventos_i = eventos[rango_agregados == i] if eventos is not None else None
+        resultado.append((tablas_i, eventos_i))
+    return resultado
+
+
+# Nombres de las tablas extraidas de un lote en los checkpoints
+TABLAS_LOTE = ['servicio', 'cliente_usuario', 'estado_servicio', 'novedad_servicio']
+
+
+def _a_checkpoint(tablas: list, eventos: pd.DataFrame = None) -> dict:
+    guardadas = dict(zip(TABLAS_LOTE, tablas))
+    if eventos is not None:
+        guardadas['eventos'] = eventos.reset_index()
+    return guardadas
+
+
+def _de_checkpoint(guardadas: dict) -> tuple:
+    eventos = guardadas.pop('eventos', None)
+    if eventos is not None:
+        eventos = eventos.set_index('servicio_id')
+    return list(guardadas.values()), eventos
+
+
+def extraer_lote(oltp_conn: Engine, olap_conn: Engine, config: dict, desde=None, hasta=None,
+                 servicios: list = None) -> tuple:
+    """
+    :param oltp_conn: sqlalchemy engine de la base de datos OLTP
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config: configuracion del ETL (config.yml)
+    :param desde: ultimo id de servicio ya procesado (None extrae desde el inicio)
+    :param hasta: ultimo id de servicio a extraer (None extrae hasta el final)
+    :param servicios: ids de servicio a extraer (None extrae todo el rango)
+    :return: (tablas del lote, eventos agregados o None, rango de fechas de dim_tiempo)
+    """
+    if servicios is None:
+        print(f"Extraer servicios del OLTP con id en ({desde}, {hasta}]")
+    else:
+        print(f"Extraer {len(servicios)} servicios del OLTP por id")
+    # En modo ELT los estados y novedades se agregan en el OLTP y no se descargan
+    # Las tablas del OLTP, los eventos agregados y el calendario del OLAP se leen a la vez
+    workers = config['EXTRACT_WORKERS']
+    tareas = {
+        'tablas': lambda: extract.extract_incremental(oltp_conn, desde=desde, hasta=hasta, spec=config['EXTRACT_SPEC'],
+                                                      eventos=not config['ELT_AGGREGATES'], workers=workers,
+                                                      servicios=servicios),
+        'rango_fechas_tiempo': lambda: utils_etl.rango_fechas_tiempo(olap_conn),
+    }
+    if config['ELT_AGGREGATES']:
+        tareas['eventos'] = lambda: extract.extract_eventos_agregados(oltp_conn, desde=desde, hasta=hasta,
+                                                                        servicios=servicios)
+    resultado = extract.ejecutar_concurrente(tareas, workers)
+    return resultado['tablas'], resultado.get('eventos'), resultado['rango_fechas_tiempo']
+
+
+def transformar_lote(tablas: list, mapas: dict, eventos: pd.DataFrame = None, particiones: int = 1,
+                     pool: ProcessPoolExecutor = None):
+    """
+    :param tablas: tablas extraidas del lote (ver extraer_lote)
+    :param mapas: mapas de llaves de las dimensiones (ver lookup.cargar_mapas)
+    :param eventos: eventos agregados por servicio (modo ELT) o None
+    :param particiones: cantidad de particiones cuando se transforma en el pool
+    :param pool: pool de procesos (iniciado con los mapas) para transformar el lote por particiones
+    :return: generador del hecho de servicios transformado, una particion a la vez a medida que terminan
+    """
+    if pool is None:
+        print("transformando datos para el hecho de servicios")
+        hecho_servicios = transform.transform_hecho_servicios(tablas, mapas, eventos=eventos)
+        print("total servicios: ", len(hecho_servicios))
+        yield hecho_servicios
+        return
+
+    # Cada particion se transforma en un proceso y se entrega apenas termina
+    partes = particionar(tablas, eventos, particiones)
+    print(f"transformando datos para el hecho de servicios en {len(partes)} particiones")
+    futuros = [pool.submit(_transformar_particion, tablas_i, eventos_i) for tablas_i, eventos_i in partes]
+    for futuro in as_completed(futuros):
+        try:
+            hecho_servicios, registros = futuro.result()
+        except Exception as e:
+            _registrar_metricas_worker(getattr(e, 'registros_metricas', []))
+            raise
+        _registrar_metricas_worker(registros)
+        print("particion del hecho de servicios transformada, total servicios: ", len(hecho_servicios))
+        yield hecho_servicios
+
+
+def procesar_lote(oltp_conn: Engine, olap_conn: Engine, config: dict, mapas: dict, desde=None, hasta=None,
+                  pool: ProcessPoolExecutor = None, servicios: list = None) -> pd.Series:
+    """
+    Extrae, transforma y carga el hecho de servicios para los ids en el rango (desde, hasta],
+    o recalcula y reemplaza las filas de una lista de servicios ya cargados.
+    Con checkpoints activos guarda la salida de cada etapa y retoma el lote desde la ultima completada.
+
+    :param oltp_conn: sqlalchemy engine de la base de datos OLTP
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config: configuracion del ETL (config.yml)
+    :param mapas: mapas de llaves de las dimensiones (ver lookup.cargar_mapas)
+    :param desde: ultimo id de servicio ya procesado (None procesa desde el inicio)
+    :param hasta: ultimo id de servicio a procesar (None procesa hasta el final)
+    :param pool: pool de procesos (iniciado con los mapas) para transformar el lote por particiones
+    :param servicios: ids de servicios ya cargados a recalcular; sus filas se reemplazan con load.upsert
+    :return: ids de los servicios extraidos en el lote
+    """
+    lote = checkpoint.lote(desde, hasta, servicios)
+    etapa = checkpoint.etapa(lote)
+    if etapa is None:
+        tablas, eventos, rango_fechas = extraer_lote(oltp_conn, olap_conn, config, desde, hasta, servicios)
+        checkpoint.guardar(lote, 'extract', _a_checkpoint(tablas, eventos))
+        checkpoint.completar(lote, 'extract')
+    else:
+        print(f"Lote {lote} con etapa {etapa} completada, se lee desde los checkpoints")
+        tablas, eventos = _de_checkpoint(checkpoint.leer(lote, 'extract'))
+        rango_fechas = None
+    ids = tablas[0]['id'].copy()
+    if etapa == 'load' or ids.empty:
+        return ids
+
+    metodo = config['LOAD_METHOD'].get('hecho_servicios', 'insert')
+    if etapa == 'transform':
+        hechos = checkpoint.leer(lote, 'transform').items()
+    else:
+        extender_tiempo(olap_conn, tablas[0], config, rango_fechas)
+        hechos = ((f'hecho_servicios_{i}', hecho) for i, hecho in
+                  enumerate(transformar_lote(tablas, mapas, eventos, config['PARALLEL_WORKERS'], pool)))
+        if checkpoint.activo():
+            # Con checkpoints el lote transformado se guarda completo antes de empezar a cargarlo
+            hechos = dict(hechos)
+            checkpoint.guardar(lote, 'transform', hechos)
+            checkpoint.completar(lote, 'transform')
+            hechos = hechos.items()
+
+    # Buckets de los agregados que tocan las filas del lote; un recalculo tambien toca los de sus filas actuales
+    tocados = {}
+    if config['ROLLUPS'] and servicios is not None:
+        tocados = rollups.buckets_cargados(olap_conn, servicios)
+
+    # Las particiones ya cargadas antes de una caida no se vuelven a insertar
+    cargadas = checkpoint.cargadas(lote)
+    for nombre, hecho_servicios in hechos:
+        if config['ROLLUPS']:
+            tocados = rollups.unir(tocados, rollups.buckets(hecho_servicios))
+        if nombre in cargadas:
+            continue
+        print("cargando datos en la base de datos OLAP para el hecho de servicios, total servicios: ",
+              len(hecho_servicios))
+        if servicios is None:
+            load.load(hecho_servicios, etl_conn=olap_conn, tname='hecho_servicios', replace=False,
+                      method=metodo, key='id_servicio')
+        else:
+            load.upsert(hecho_servicios, etl_conn=olap_conn, tname='hecho_servicios', key='id_servicio',
+                        method=metodo)
+        checkpoint.registrar_carga(lote, nombre)
+    if tocados:
+        rollups.refrescar(olap_conn, tocados)
+    checkpoint.completar(lote, 'load')
+    return ids
+
+
+def transformar_desde_cache(config: dict, run_id: str = None):
+    """
+    Repite la transformacion del hecho sobre las extracciones guardadas en los checkpoints,
+    sin conectarse a ninguna base de datos. El resultado reemplaza los checkpoints de transform,
+    asi una ejecucion con --resume carga directamente lo transformado.
+
+    :param config: configuracion del ETL (config.yml)
+    :param run_id: ejecucion cuyos checkpoints se usan, por defecto la mas reciente con extracciones
+    :return: void
+    """
+    manifiesto = checkpoint.abrir(config['CHECKPOINT'].get('dir', checkpoint.CHECKPOINT_DIR), run_id)
+    print(f"Transformando desde los checkpoints de la ejecucion {manifiesto['run_id']}")
+    # Los mapas de llaves salen del cache local, sin cache no hay como resolverlas sin el OLAP
+    mapas = lookup.cargar_mapas_cache(config['LOOKUP_CACHE_DIR'])
+
+    for lote in checkpoint.lotes():
+        if checkpoint.etapa(lote) is None or lote == 'dimensiones':
+            continue
+        tablas, eventos = _de_checkpoint(checkpoint.leer(lote, 'extract'))
+        if tablas[0].empty:
+            continue
+        print(f"Transformando el lote {lote}")
+        hechos = list(transformar_lote(tablas, mapas, eventos))
+        checkpoint.guardar(lote, 'transform', {f'hecho_servicios_{i}': hecho for i, hecho in enumerate(hechos)})
+        if checkpoint.etapa(lote) == 'extract':
+            checkpoint.completar(lote, 'transform')
+
+
+def actualizar_eventos_tardios(oltp_conn: Engine, olap_conn: Engine, config: dict, mapas: dict, watermark,
+                               marcas: dict, topes: dict, pool: ProcessPoolExecutor = None):
+    """
+    Captura de cambios de estados y novedades: recalcula solo las filas del hecho de los servicios
+    ya cargados que recibieron eventos con id posterior al watermark de su tabla.
+
+    :param oltp_conn: sqlalchemy engine de la base de datos OLTP
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config: configuracion del ETL (config.yml)
+    :param mapas: mapas de llaves de las dimensiones (ver lookup.cargar_mapas)
+    :param watermark: watermark de mensajeria_servicio, ultimo servicio ya cargado
+    :param marcas: tabla de eventos -> watermark (ultimo id de evento procesado)
+    :param topes: tabla de eventos -> ultimo id al iniciar la carga, leido antes de extraer servicios nuevos
+    :param pool: pool de procesos para transformar por particiones
+    :return: void, los watermarks de las tablas de eventos avanzan hasta su tope
+    """
+    afectados = set()
+    for tabla in utils_etl.TABLAS_EVENTOS:
+        # Sin watermark previo los eventos existentes ya estan en el hecho, solo se registra el tope
+        if watermark is None or marcas[tabla] is None or topes[tabla] is None or topes[tabla] <= marcas[tabla]:
+            continue
+        afectados.update(extract.extract_servicios_afectados(oltp_conn, tabla, desde=marcas[tabla], hasta=topes[tabla],
+                                                             servicio_hasta=watermark, spec=config['EXTRACT_SPEC']))
+
+    servicios = sorted(int(s) for s in afectados)
+    print(f"Servicios cargados con eventos tardios: {len(servicios)}")
+    # Los recalculos se hacen en lotes de a lo sumo CHUNK_SIZE servicios
+    tamano = config.get('CHUNK_SIZE') or len(servicios) or 1
+    for i in range(0, len(servicios), tamano):
+        procesar_lote(oltp_conn, olap_conn, config, mapas, pool=pool, servicios=servicios[i:i + tamano])
+
+    for tabla in utils_etl.TABLAS_EVENTOS:
+        if topes[tabla] is not None and topes[tabla] != marcas[tabla]:
+            utils_etl.actualizar_watermark(olap_conn, tabla, topes[tabla])
+
+
+def cargar_hechos(oltp_conn: Engine, olap_conn: Engine, config: dict):
+    """
+    Carga el hecho de servicios. Con CHUNK_SIZE procesa mensajeria_servicio por rangos de ids,
+    cargando cada lote antes de extraer el siguiente para que la memoria no crezca con el historico.
+    En modo incremental primero recalcula los servicios ya cargados con eventos tardios.
+    Con ROLLUPS cada lote recalcula solo los buckets de los agregados que tocaron sus filas.
+
+    :param oltp_conn: sqlalchemy engine de la base de datos OLTP
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config: configuracion del ETL (config.yml)
+    :return: void
+    """
+    print("Cargar mapas de llaves de las dimensiones, watermarks y rangos de ids")
+    # Sin modo incremental se procesa todo el historico
+    tareas = {
+        'mapas': lambda: lookup.cargar_mapas(olap_conn, config['LOOKUP_CACHE_DIR']),
+        'watermark': lambda: utils_etl.obtener_watermark(olap_conn, 'mensajeria_servicio') if config['INCREMENTAL'] else None,
+        'rango_ids': lambda: utils_etl.rango_ids_servicio(oltp_conn),
+    }
+    if config['INCREMENTAL']:
+        for tabla in utils_etl.TABLAS_EVENTOS:
+            tareas[f'marca_{tabla}'] = lambda tabla=tabla: utils_etl.obtener_watermark(olap_conn, tabla)
+            tareas[f'tope_{tabla}'] = lambda tabla=tabla: utils_etl.ultimo_id(oltp_conn, tabla)
+    inicio = extract.ejecutar_concurrente(tareas, config['EXTRACT_WORKERS'])
+    mapas = inicio['mapas']
+    watermark = inicio['watermark']
+
+    pool = None
+    if config.get('PARALLEL_WORKERS', 1) > 1:
+        pool = ProcessPoolExecutor(max_workers=config['PARALLEL_WORKERS'], initializer=_iniciar_worker,
+                                   initargs=(mapas,))
+    try:
+        if config['ROLLUPS']:
+            rollups.reconstruir_vacios(olap_conn)
+        if config['INCREMENTAL']:
+            actualizar_eventos_tardios(oltp_conn, olap_conn, config, mapas, watermark,
+                                       marcas={t: inicio[f'marca_{t}'] for t in utils_etl.TABLAS_EVENTOS},
+                                       topes={t: inicio[f'tope_{t}'] for t in utils_etl.TABLAS_EVENTOS}, pool=pool)
+
+        chunk_size = config.get('CHUNK_SIZE')
+        if not chunk_size:
+            ids = procesar_lote(oltp_conn, olap_conn, config, mapas, desde=watermark, pool=pool)
+            if config['INCREMENTAL'] and not ids.empty:
+                utils_etl.actualizar_watermark(olap_conn, 'mensajeria_servicio', ids.max())
+            return
+
+        primer_id, ultimo_id = inicio['rango_ids']
+        if ultimo_id is None:
+            return
+        desde = watermark if watermark is not None else primer_id - 1
+        while desde < ultimo_id:
+            hasta = min(desde + chunk_size, ultimo_id)
+            procesar_lote(oltp_conn, olap_conn, config, mapas, desde=desde, hasta=hasta, pool=pool)
+            # El rango ya quedo cargado, el watermark avanza lote a lote
+            if config['INCREMENTAL']:
+                utils_etl.actualizar_watermark(olap_conn, 'mensajeria_servicio', hasta)
+            desde = hasta
+    finally:
+        if pool is not None:
+            pool.shutdown()
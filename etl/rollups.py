@@ -0,0 +1,131 @@
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import column, delete, func, insert, literal_column, select, table, text, tuple_
+from sqlalchemy.engine import Engine
+
+from etl import metrics
+
+# Agregados del hecho: tabla -> (llave de la dimension, periodo, divisor de key_dim_tiempo)
+# key_dim_tiempo es YYYYMMDDHH, dividido en 100 da el dia YYYYMMDD y en 10000 el mes YYYYMM
+ROLLUPS = {
+    'rollup_sede_dia': ('key_dim_sede', 'dia', 100),
+    'rollup_mensajero_dia': ('key_dim_mensajero', 'dia', 100),
+    'rollup_cliente_mes': ('key_dim_cliente', 'mes', 10000),
+}
+
+# Buckets que se recalculan por consulta
+TAMANO_BLOQUE = 1000
+
+_hecho = table('hecho_servicios', column('id_servicio'), column('key_dim_sede'), column('key_dim_mensajero'),
+               column('key_dim_cliente'), column('key_dim_tiempo'), column('tiempo_total_espera'),
+               column('cantidad_novedades_tipo_1'), column('cantidad_novedades_tipo_2'))
+
+
+def _periodo(divisor: int):
+    # Division entera de columnas enteras, igual en PostgreSQL y sqlite
+    return literal_column(f'key_dim_tiempo / {divisor}')
+
+
+def _agregado(tname: str, buckets: list = None):
+    """
+    :param tname: tabla de agregados
+    :param buckets: (llave, periodo) a recalcular, None agrega todo el hecho
+    :return: SELECT de los agregados de la tabla desde hecho_servicios
+    """
+    llave, periodo, divisor = ROLLUPS[tname]
+    periodo_hecho = _periodo(divisor)
+    query = select(
+        _hecho.c[llave],
+        periodo_hecho.label(periodo),
+        func.count().label('servicios'),
+        func.sum(_hecho.c.tiempo_total_espera).label('tiempo_total_espera_suma'),
+        func.count(_hecho.c.tiempo_total_espera).label('tiempo_total_espera_conteo'),
+        func.sum(_hecho.c.cantidad_novedades_tipo_1).label('novedades_tipo_1'),
+        func.sum(_hecho.c.cantidad_novedades_tipo_2).label('novedades_tipo_2'),
+    ).group_by(_hecho.c[llave], periodo_hecho)
+    if buckets is not None:
+        llaves = sorted({b[0] for b in buckets})
+        periodos = [b[1] for b in buckets]
+        # El rango de key_dim_tiempo y las llaves usan los indices del hecho antes de filtrar por bucket
+        query = query.where(_hecho.c[llave].in_(llaves),
+                            _hecho.c.key_dim_tiempo.between(min(periodos) * divisor, (max(periodos) + 1) * divisor - 1),
+                            tuple_(_hecho.c[llave], periodo_hecho).in_(buckets))
+    return query
+
+
+def _columnas(tname: str) -> list:
+    llave, periodo, _ = ROLLUPS[tname]
+    return [llave, periodo, 'servicios', 'tiempo_total_espera_suma', 'tiempo_total_espera_conteo',
+            'novedades_tipo_1', 'novedades_tipo_2']
+
+
+def buckets(hecho_servicios: DataFrame) -> dict:
+    """
+    :param hecho_servicios: filas del hecho (al menos key_dim_tiempo y las llaves de las dimensiones)
+    :return: tabla de agregados -> conjunto de (llave, periodo) que tocan las filas
+    """
+    resultado = {}
+    for tname, (llave, _, divisor) in ROLLUPS.items():
+        filas = hecho_servicios[[llave, 'key_dim_tiempo']].dropna()
+        resultado[tname] = set(zip(filas[llave].astype('int64'), filas['key_dim_tiempo'].astype('int64') // divisor))
+    return resultado
+
+
+def unir(*grupos: dict) -> dict:
+    """
+    :param grupos: resultados de buckets
+    :return: union de los buckets por tabla de agregados
+    """
+    return {tname: set().union(*(grupo.get(tname, set()) for grupo in grupos)) for tname in ROLLUPS}
+
+
+def buckets_cargados(conn_olap: Engine, servicios: list) -> dict:
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param servicios: ids de servicio ya cargados que se van a reemplazar
+    :return: buckets de las filas actuales de esos servicios, un recalculo puede sacarlos de su bucket anterior
+    """
+    query = select(_hecho.c.key_dim_sede, _hecho.c.key_dim_mensajero, _hecho.c.key_dim_cliente,
+                   _hecho.c.key_dim_tiempo).where(_hecho.c.id_servicio.in_([int(s) for s in servicios]))
+    return buckets(pd.read_sql(query, conn_olap))
+
+
+@metrics.instrumentar('load')
+def refrescar(conn_olap: Engine, tocados: dict) -> int:
+    """
+    Recalcula desde hecho_servicios solo los buckets de los agregados que tocaron las filas cargadas.
+
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param tocados: tabla de agregados -> (llave, periodo) a recalcular (ver buckets)
+    :return: numero de buckets recalculados
+    """
+    total = 0
+    for tname, conjunto in tocados.items():
+        llave, periodo, _ = ROLLUPS[tname]
+        rollup = table(tname, *[column(c) for c in _columnas(tname)])
+        conjunto = sorted(conjunto)
+        for i in range(0, len(conjunto), TAMANO_BLOQUE):
+            bloque = [(int(k), int(p)) for k, p in conjunto[i:i + TAMANO_BLOQUE]]
+            # Borrar y reinsertar en la misma transaccion, los tableros no ven el bucket vacio
+            with conn_olap.begin() as con:
+                con.execute(delete(rollup).where(tuple_(rollup.c[llave], rollup.c[periodo]).in_(bloque)))
+                con.execute(insert(rollup).from_select(_columnas(tname), _agregado(tname, bloque)))
+        total += len(conjunto)
+        print(f'{tname}: {len(conjunto)} buckets recalculados')
+    return total
+
+
+def reconstruir_vacios(conn_olap: Engine):
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :return: void, llena por completo las tablas de agregados vacias (recien creadas) si el hecho ya tiene filas
+    """
+    with conn_olap.connect() as con:
+        if con.execute(text('select 1 from hecho_servicios limit 1;')).fetchone() is None:
+            return
+        vacias = [tname for tname in ROLLUPS if con.execute(text(f'select 1 from {tname} limit 1;')).fetchone() is None]
+    for tname in vacias:
+        print(f'Construyendo {tname} desde todo el hecho de servicios')
+        rollup = table(tname, *[column(c) for c in _columnas(tname)])
+        with conn_olap.begin() as con:
+            con.execute(insert(rollup).from_select(_columnas(tname), _agregado(tname)))
@@ -3,13 +3,52 @@ import datetime
 from datetime import timedelta, date, datetime
 from typing import Tuple, Any
 
-import holidays
-import numpy as np
 import pandas as pd
-from mlxtend.frequent_patterns import apriori
-from mlxtend.preprocessing import TransactionEncoder
 from pandas import DataFrame
 
+from etl import metrics
+
+# Estados del servicio usados para calcular los tiempos de espera
+ESTADOS_SERVICIO = [1, 2, 4, 5]
+
+# Tipos de novedad que se cuentan en el hecho
+TIPOS_NOVEDAD = [1, 2]
+
+# Tipos compactos del hecho: llaves enteras nulables, conteos enteros e intervalos timedelta
+DTYPES_HECHO = {
+    'id_servicio': 'Int64',
+    'key_dim_cliente': 'Int32',
+    'key_dim_mensajero': 'Int32',
+    'key_dim_tiempo': 'Int32',
+    'key_dim_sede': 'Int32',
+    'tiempo_total_espera': 'timedelta64[ns]',
+    'tiempo_espera_inicial': 'timedelta64[ns]',
+    'tiempo_espera_asignado': 'timedelta64[ns]',
+    'tiempo_espera_recogido': 'timedelta64[ns]',
+    'tiempo_espera_en_destino': 'timedelta64[ns]',
+    'cantidad_novedades_tipo_1': 'Int32',
+    'cantidad_novedades_tipo_2': 'Int32',
+}
+
+# Columnas de eventos agregados por servicio
+COLUMNAS_EVENTOS = [f'estado_{estado_id}_fecha_hora' for estado_id in ESTADOS_SERVICIO] + \
+                   [f'cantidad_novedades_tipo_{tipo}' for tipo in TIPOS_NOVEDAD]
+
+
+def _hora_a_timedelta(hora: pd.Series) -> pd.Series:
+    """
+    Convierte una columna de horas en timedelta truncado a segundos. El extract trae las horas
+    como segundos desde la medianoche (ver 'segundos' en EXTRACT_SPEC) y se convierten sin pasar por texto;
+    las horas como datetime.time (tablas leidas sin spec) se convierten elemento a elemento.
+    """
+    if pd.api.types.is_timedelta64_dtype(hora):
+        return hora.dt.floor('s')
+    if pd.api.types.is_numeric_dtype(hora):
+        return pd.to_timedelta(hora, unit='s').dt.floor('s')
+    return pd.to_timedelta(hora.astype('string'), errors='coerce').dt.floor('s')
+
+
+@metrics.instrumentar('transform')
 def clean_hecho_servicios(hecho_servicios: DataFrame) -> DataFrame:
     """
     Limpia el DataFrame hecho_servicios analizando y eliminando registros con valores nulos
@@ -92,8 +131,53 @@ def clean_hecho_servicios(hecho_servicios: DataFrame) -> DataFrame:
     return hecho_servicios_final
 
 
-def transform_hecho_servicios(tablas: list[DataFrame]) -> DataFrame:
-    servicio, cliente_usuario, estado_servicio, novedad_servicio, dim_tiempo, dim_sede, dim_cliente, dim_mensajero = tablas
+@metrics.instrumentar('transform')
+def agregar_eventos(estado_servicio: DataFrame, novedad_servicio: DataFrame) -> DataFrame:
+    """
+    Agrega los eventos de cada servicio: ultima fecha-hora de cada estado y cantidad de
+    novedades por tipo. Es el equivalente en pandas de extract.extract_eventos_agregados.
+
+    Args:
+        estado_servicio: estados de los servicios (servicio_id, estado_id, fecha, hora)
+        novedad_servicio: novedades de los servicios (servicio_id, tipo_novedad_id)
+
+    Returns:
+        DataFrame: una fila por servicio_id con las columnas de COLUMNAS_EVENTOS
+    """
+    # Ultima fecha-hora de cada estado por servicio en un solo groupby
+    estados = estado_servicio[estado_servicio['estado_id'].isin(ESTADOS_SERVICIO)]
+    fecha_hora_estado = estados['fecha'].dt.normalize() + _hora_a_timedelta(estados['hora'])
+    ultimo_estado = fecha_hora_estado.groupby([estados['servicio_id'], estados['estado_id']]).max()\
+                                     .unstack('estado_id')\
+                                     .reindex(columns=ESTADOS_SERVICIO)
+    ultimo_estado.columns = [f'estado_{estado_id}_fecha_hora' for estado_id in ultimo_estado.columns]
+
+    # Cantidad de novedades por tipo por servicio
+    novedades = novedad_servicio[novedad_servicio['tipo_novedad_id'].isin(TIPOS_NOVEDAD)]
+    cantidad_novedades = novedades.groupby(['servicio_id', 'tipo_novedad_id']).size()\
+                                  .unstack('tipo_novedad_id')\
+                                  .reindex(columns=TIPOS_NOVEDAD)
+    cantidad_novedades.columns = [f'cantidad_novedades_tipo_{tipo}' for tipo in cantidad_novedades.columns]
+
+    return ultimo_estado.join(cantidad_novedades, how='outer')
+
+
+@metrics.instrumentar('transform')
+def transform_hecho_servicios(tablas: list[DataFrame], mapas: dict, eventos: DataFrame = None) -> DataFrame:
+    """
+    Construye el hecho de servicios asignando las llaves de dimension con los mapas
+    id natural -> llave subrogada y calculando tiempos y novedades.
+
+    Args:
+        tablas: [servicio, cliente_usuario, estado_servicio, novedad_servicio], o solo
+            [servicio, cliente_usuario] si se pasan los eventos ya agregados
+        mapas: mapas de llaves por dimension (ver etl.lookup.cargar_mapas)
+        eventos: eventos agregados por servicio (ver agregar_eventos); None los calcula de tablas
+
+    Returns:
+        DataFrame: hecho_servicios limpio
+    """
+    servicio, cliente_usuario = tablas[:2]
 
     # Asigna el mensajero usando una estrategia de respaldo - si mensajero3_id está vacío, usa mensajero2_id,
     # si mensajero2_id está vacío usa mensajero_id. Toma el primer valor no nulo encontrado.
@@ -101,96 +185,89 @@ def transform_hecho_servicios(tablas: list[DataFrame]) -> DataFrame:
         ['mensajero3_id', 'mensajero2_id', 'mensajero_id']
     ].bfill(axis=1).iloc[:, 0]
 
-    servicio['fecha_solicitud_str'] = servicio['fecha_solicitud'].dt.strftime('%Y-%m-%d')
-    servicio['hora_solicitud_str'] = servicio['hora_solicitud'].apply(lambda x: x.strftime('%H:%M:%S') if pd.notnull(x) else None)
+    # Fecha y hora de la solicitud combinadas con aritmetica de fechas, sin pasar por texto
+    hora_solicitud = _hora_a_timedelta(servicio['hora_solicitud'])
+    servicio['fecha_hora_solicitud'] = servicio['fecha_solicitud'].dt.normalize() + hora_solicitud
+    servicio['hora_solicitud'] = (hora_solicitud // pd.Timedelta(hours=1)).astype('Int64')
 
-    servicio['fecha_hora_solicitud'] = pd.to_datetime(servicio['fecha_solicitud_str'] + ' ' + servicio['hora_solicitud_str'])
+    # La sede sale del usuario que solicito el servicio
+    sede_por_usuario = pd.Series(cliente_usuario['sede_id'].to_numpy(), index=cliente_usuario['id'].to_numpy())
+    sede_por_usuario = sede_por_usuario[~sede_por_usuario.index.duplicated(keep='last')]
 
-    servicio['hora_solicitud'] = servicio['hora_solicitud'].apply(lambda x: x.hour if pd.notnull(x) else None)
+    # Renombrar columna id a id_servicio para coincidir con el esquema
+    hecho_servicios = servicio[['id', 'fecha_hora_solicitud']].rename(columns={'id': 'id_servicio'})
 
-    servicio = servicio[['id', 'cliente_id', 'mensajero_id', 'fecha_solicitud', 'hora_solicitud', 'usuario_id', 'fecha_hora_solicitud']]
+    # Asignar llaves: dim_tiempo se calcula de la fecha y la hora, el resto con un map por dimension
+    hecho_servicios['key_dim_tiempo'] = key_dim_tiempo(servicio['fecha_solicitud'], servicio['hora_solicitud'])
+    hecho_servicios['key_dim_sede'] = servicio['usuario_id'].map(sede_por_usuario).map(mapas['dim_sede'])
+    hecho_servicios['key_dim_cliente'] = servicio['cliente_id'].map(mapas['dim_cliente'])
+    hecho_servicios['key_dim_mensajero'] = servicio['mensajero_id'].map(mapas['dim_mensajero'])
 
-    hecho_servicios = servicio.merge(cliente_usuario, left_on='usuario_id', right_on='id', how='left')[
-        ['id_x', 'cliente_id_x', 'mensajero_id', 'fecha_solicitud', 'hora_solicitud', 'sede_id', 'fecha_hora_solicitud']
-    ].rename(columns={'id_x': 'id', 'cliente_id_x': 'cliente_id'})
+    hecho_servicios = hecho_servicios.drop_duplicates()
+    hecho_servicios.set_index('id_servicio', inplace=True)
 
-    hecho_servicios = hecho_servicios.merge(dim_tiempo, left_on=['fecha_solicitud', 'hora_solicitud'], right_on=['fecha', 'hora_dia'], how='left')[
-        ['id', 'cliente_id', 'mensajero_id', 'fecha_solicitud', 'hora_solicitud', 'sede_id', 'key_dim_tiempo', 'fecha_hora_solicitud']
-    ]
+    # Ultima fecha-hora por estado y cantidad de novedades por tipo de cada servicio
+    if eventos is None:
+        eventos = agregar_eventos(*tablas[2:4])
+    # Un estado sin registros en el lote llega como columna vacia sin tipo fecha
+    eventos = eventos.reindex(columns=COLUMNAS_EVENTOS)\
+                     .astype({f'estado_{estado_id}_fecha_hora': 'datetime64[ns]' for estado_id in ESTADOS_SERVICIO})
+    hecho_servicios = hecho_servicios.join(eventos)
+
+    # Calcular las diferencias de tiempo; quedan como timedelta y el loader las escribe como interval
+    hecho_servicios['tiempo_total_espera'] = hecho_servicios['estado_5_fecha_hora'] - hecho_servicios['fecha_hora_solicitud']
+    hecho_servicios['tiempo_espera_inicial'] = hecho_servicios['estado_1_fecha_hora'] - hecho_servicios['fecha_hora_solicitud']
+    hecho_servicios['tiempo_espera_asignado'] = hecho_servicios['estado_2_fecha_hora'] - hecho_servicios['estado_1_fecha_hora']
+    hecho_servicios['tiempo_espera_recogido'] = hecho_servicios['estado_4_fecha_hora'] - hecho_servicios['estado_2_fecha_hora']
+    hecho_servicios['tiempo_espera_en_destino'] = hecho_servicios['estado_5_fecha_hora'] - hecho_servicios['estado_4_fecha_hora']
+
+    # Los servicios sin novedades de un tipo quedan en 0
+    for tipo_novedad in TIPOS_NOVEDAD:
+        hecho_servicios[f'cantidad_novedades_tipo_{tipo_novedad}'] = hecho_servicios[f'cantidad_novedades_tipo_{tipo_novedad}'].fillna(0)
 
-    hecho_servicios = hecho_servicios.merge(dim_sede, left_on='sede_id', right_on='id_sede', how='left')[
-        ['id', 'cliente_id', 'mensajero_id', 'fecha_solicitud', 'hora_solicitud', 'sede_id', 'key_dim_tiempo', 'key_dim_sede', 'fecha_hora_solicitud']
-    ]
+    hecho_servicios.reset_index(inplace=True)
 
-    hecho_servicios = hecho_servicios.merge(dim_cliente, left_on='cliente_id', right_on='id_cliente', how='left')[
-        ['id', 'cliente_id', 'mensajero_id', 'fecha_solicitud', 'hora_solicitud', 'sede_id',
-         'key_dim_tiempo', 'key_dim_sede', 'key_dim_cliente', 'fecha_hora_solicitud']
-    ]
+    return clean_hecho_servicios(hecho_servicios[list(DTYPES_HECHO)].astype(DTYPES_HECHO))
 
-    hecho_servicios = hecho_servicios.merge(dim_mensajero, left_on='mensajero_id', right_on='id_mensajero', how='left')[
-        ['id', 'key_dim_tiempo', 'key_dim_sede', 'key_dim_cliente', 'key_dim_mensajero', 'fecha_hora_solicitud']
-    ]
 
-    # Renombrar columna id a id_servicio para coincidir con el esquema
-    hecho_servicios = hecho_servicios.rename(columns={'id': 'id_servicio'}).drop_duplicates()
-    hecho_servicios.set_index('id_servicio', inplace=True)
+def key_dim_tiempo(fecha: pd.Series, hora: pd.Series) -> pd.Series:
+    """
+    Calcula la llave de dim_tiempo como el entero AAAAMMDDHH.
 
-    # Calcular tiempos de servicio
-    for estado_id in [1,2,4,5]:
-        estado_servicio_id = estado_servicio[estado_servicio['estado_id'] == estado_id].copy()
-        estado_servicio_id['fecha'] = estado_servicio_id['fecha'].dt.strftime('%Y-%m-%d')
-        estado_servicio_id['hora'] = estado_servicio_id['hora'].apply(lambda x: x.strftime('%H:%M:%S') if pd.notnull(x) else None)
-        estado_servicio_id['fecha_hora'] = pd.to_datetime(estado_servicio_id['fecha'] + ' ' + estado_servicio_id['hora'])
-        estado_servicio_id = estado_servicio_id.groupby('servicio_id')['fecha_hora'].max().to_frame()
-        hecho_servicios[f'estado_{estado_id}_fecha_hora'] = hecho_servicios.index.map(
-            estado_servicio_id['fecha_hora']
-        )
-
-    # Inicializar las columnas faltantes con None
-    # Calcular las diferencias de tiempo y convertir a timedelta de pandas
-    hecho_servicios['tiempo_total_espera'] = (hecho_servicios['estado_5_fecha_hora'] - hecho_servicios['fecha_hora_solicitud']).apply(lambda x: None if pd.isna(x) else str(x))
-    hecho_servicios['tiempo_espera_inicial'] = (hecho_servicios['estado_1_fecha_hora'] - hecho_servicios['fecha_hora_solicitud']).apply(lambda x: None if pd.isna(x) else str(x))
-    hecho_servicios['tiempo_espera_asignado'] = (hecho_servicios['estado_2_fecha_hora'] - hecho_servicios['estado_1_fecha_hora']).apply(lambda x: None if pd.isna(x) else str(x))
-    hecho_servicios['tiempo_espera_recogido'] = (hecho_servicios['estado_4_fecha_hora'] - hecho_servicios['estado_2_fecha_hora']).apply(lambda x: None if pd.isna(x) else str(x))
-    hecho_servicios['tiempo_espera_en_destino'] = (hecho_servicios['estado_5_fecha_hora'] - hecho_servicios['estado_4_fecha_hora']).apply(lambda x: None if pd.isna(x) else str(x))
-    
-    # Calcular los tipos de novedades
-    for tipo_novedad in [1,2]:
-        novedad_servicio_tipo = novedad_servicio[novedad_servicio['tipo_novedad_id'] == tipo_novedad]
-        novedad_servicio_tipo = novedad_servicio_tipo.groupby('servicio_id').size().to_frame(f'cantidad_novedades_tipo_{tipo_novedad}')
-        hecho_servicios[f'cantidad_novedades_tipo_{tipo_novedad}'] = hecho_servicios.index.map(
-            novedad_servicio_tipo[f'cantidad_novedades_tipo_{tipo_novedad}']
-        ).fillna(0)
+    Args:
+        fecha: Serie datetime con la fecha
+        hora: Serie con la hora del dia (0-23)
 
-    hecho_servicios.reset_index(inplace=True)
+    Returns:
+        Series: llaves de dim_tiempo, nulas donde falte la fecha o la hora
+    """
+    return (fecha.dt.year * 1000000 + fecha.dt.month * 10000 + fecha.dt.day * 100).astype('Int64') + hora
 
-    return clean_hecho_servicios(hecho_servicios[[
-        'id_servicio',
-        'key_dim_cliente',
-        'key_dim_mensajero', 
-        'key_dim_tiempo',
-        'key_dim_sede',
-        'tiempo_total_espera',
-        'tiempo_espera_inicial',
-        'tiempo_espera_asignado',
-        'tiempo_espera_recogido', 
-        'tiempo_espera_en_destino',
-        'cantidad_novedades_tipo_1',
-        'cantidad_novedades_tipo_2'
-    ]])
 
+@metrics.instrumentar('transform')
+def transform_tiempo(tablas: list[DataFrame], desde: date = None, hasta: date = None) -> DataFrame:
+    """
+    Genera el calendario de dim_tiempo (24 horas por dia) hasta el 31 de diciembre
+    del ultimo año con servicios.
 
-def transform_tiempo(tablas: list[DataFrame]) -> DataFrame:
+    Args:
+        tablas: [servicio] con la columna fecha_solicitud
+        desde: primer dia a generar; None genera desde la primera fecha de servicio
+        hasta: ultimo dia a generar; None genera hasta el fin del ultimo año con servicios
+
+    Returns:
+        DataFrame: filas de dim_tiempo con su llave, vacio si no faltan dias
+    """
 
     # Obtener el DataFrame de servicio que contiene las fechas
     servicio = tablas[0]
     
     # Obtener la primera fecha y el último año de los datos
-    first_date = servicio['fecha_solicitud'].min()
+    first_date = servicio['fecha_solicitud'].min() if desde is None else desde
     last_year = servicio['fecha_solicitud'].max().year
     
     # Crear fecha final (31 de diciembre del último año)
-    end_date = datetime(last_year, 12, 31).date()
+    end_date = datetime(last_year, 12, 31).date() if hasta is None else hasta
     
     # Generar un rango de fechas diario desde la primera fecha hasta la fecha final
     date_range = pd.date_range(start=first_date, end=end_date, freq='D')
@@ -208,8 +285,18 @@ def transform_tiempo(tablas: list[DataFrame]) -> DataFrame:
     dim_tiempo['dia_semana'] = dim_tiempo['fecha'].dt.day_name()
     dim_tiempo['mes'] = dim_tiempo['fecha'].dt.month_name()
 
-    return dim_tiempo
+    # Llave deterministica a partir de la fecha y la hora
+    dim_tiempo['key_dim_tiempo'] = key_dim_tiempo(dim_tiempo['fecha'], dim_tiempo['hora_dia'])
+
+    # Tipos compactos: 7 dias y 12 meses se repiten 24 veces por dia
+    return dim_tiempo[['key_dim_tiempo', 'fecha', 'dia_semana', 'mes', 'hora_dia']].astype({
+        'key_dim_tiempo': 'Int32',
+        'dia_semana': 'category',
+        'mes': 'category',
+        'hora_dia': 'int8',
+    })
 
+@metrics.instrumentar('transform')
 def transform_sede(tablas: list[DataFrame]) -> DataFrame:
     sede, ciudad = tablas
 
@@ -224,11 +311,13 @@ def transform_sede(tablas: list[DataFrame]) -> DataFrame:
     )[['id_sede', 'nombre_sede', 'ciudad']]
     return dim_sede
 
+@metrics.instrumentar('transform')
 def transform_cliente(tablas: list[DataFrame]) -> DataFrame:
     cliente = tablas[0]
     dim_cliente = cliente[['cliente_id', 'nombre']].rename(columns={'cliente_id': 'id_cliente', 'nombre': 'nombre_cliente'})
     return dim_cliente
 
+@metrics.instrumentar('transform')
 def transform_mensajero(tablas: list[DataFrame]) -> DataFrame:
     mensajero, user = tablas
 
@@ -1,9 +1,34 @@
-from sqlalchemy import Engine, text
+from sqlalchemy import Engine, create_engine, inspect, text
 
-def new_data(conn_oltp: Engine, conn_olap: Engine) -> bool:
-    # Ultimo id en la tabla de hecho_servicios
-    query_ultimo_id_olap = text('select max(id_servicio) from hecho_servicios;')
+from etl import rollups
 
+# Tabla del OLAP donde se guarda el ultimo id procesado de cada tabla del OLTP
+TABLA_WATERMARK = 'etl_watermark'
+
+# Tablas de eventos del OLTP cuyos cambios tardios se capturan por id (ver extract.extract_servicios_afectados)
+TABLAS_EVENTOS = ['mensajeria_estadosservicio', 'mensajeria_novedadesservicio']
+
+# Menor llave AAAAMMDDHH de dim_tiempo; las llaves SERIAL de versiones anteriores quedan por debajo
+LLAVE_TIEMPO_MINIMA = 1900010100
+
+def crear_engine(config_db: dict, config_pool: dict = None) -> Engine:
+    """
+    :param config_db: configuracion de la base de datos (drivername, user, password, host, port, dbname)
+    :param config_pool: pool_size, max_overflow, pool_pre_ping, pool_recycle y statement_timeout_ms
+    :return: sqlalchemy engine con el pool de conexiones configurado
+    """
+    url = (f"{config_db['drivername']}://{config_db['user']}:{config_db['password']}@{config_db['host']}:"
+           f"{config_db['port']}/{config_db['dbname']}")
+    config_pool = dict(config_pool or {})
+    statement_timeout = config_pool.pop('statement_timeout_ms', None)
+    connect_args = {}
+    if statement_timeout:
+        # Cancela en el servidor las consultas que superen el tiempo maximo
+        connect_args['options'] = f'-c statement_timeout={int(statement_timeout)}'
+    return create_engine(url, connect_args=connect_args, **config_pool)
+
+
+def new_data(conn_oltp: Engine, conn_olap: Engine, incremental: bool = True) -> bool:
     # Ultimo id en la tabla de mensajeria_servicio del OLTP
     query_ultimo_id_oltp = text('select max(id) from mensajeria_servicio;')
 
@@ -14,21 +39,165 @@ def new_data(conn_oltp: Engine, conn_olap: Engine) -> bool:
             return True
         print(f'Ultimo id en la tabla de mensajeria_servicio: {ultimo_id_oltp}')
 
-    with conn_olap.connect() as con:
-        rs = con.execute(query_ultimo_id_olap)
-        ultimo_id_olap = rs.fetchone()[0]
-        if ultimo_id_olap is None:
-            print(f'No hay datos en la tabla de hecho_servicios')
-            return True
-        print(f'Ultimo id en la tabla de hecho_servicios: {ultimo_id_olap}')
+    # Ultimo servicio procesado; sin watermark es el ultimo id de hecho_servicios. Con el watermark
+    # los servicios descartados por la limpieza al final del rango no se reportan como nuevos en cada revision
+    if incremental:
+        ultimo_id_olap = obtener_watermark(conn_olap, 'mensajeria_servicio')
+    else:
+        # Sin carga incremental no se escriben watermarks
+        with conn_olap.connect() as con:
+            ultimo_id_olap = con.execute(text('select max(id_servicio) from hecho_servicios;')).fetchone()[0]
+    if ultimo_id_olap is None:
+        print(f'No hay datos en la tabla de hecho_servicios')
+        return True
 
     if ultimo_id_oltp > ultimo_id_olap:
         print(f'Hay nuevos datos en la tabla de mensajeria_servicio')
         return True
-    else:
-        print(f'No hay nuevos datos en la tabla de mensajeria_servicio')
+    print(f'No hay nuevos datos en la tabla de mensajeria_servicio')
+    if not incremental:
         return False
 
+    # Estados y novedades que llegan tarde a servicios ya cargados, solo la carga incremental los recoge
+    for tabla in TABLAS_EVENTOS:
+        watermark = obtener_watermark(conn_olap, tabla)
+        ultimo_id_eventos = ultimo_id(conn_oltp, tabla)
+        if ultimo_id_eventos is not None and (watermark is None or ultimo_id_eventos > watermark):
+            print(f'Hay nuevos eventos en la tabla de {tabla}')
+            return True
+    print(f'No hay nuevos eventos en las tablas de estados y novedades')
+    return False
+
+
+def obtener_watermark(conn_olap: Engine, tabla: str):
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param tabla: tabla del OLTP de la que se quiere el watermark
+    :return: ultimo id procesado de la tabla, None si nunca se ha procesado
+    """
+    query = text(f'select ultimo_id from {TABLA_WATERMARK} where tabla = :tabla;')
+    with conn_olap.connect() as con:
+        fila = con.execute(query, {'tabla': tabla}).fetchone()
+    if fila is not None:
+        print(f'Watermark de la tabla {tabla}: {fila[0]}')
+        return fila[0]
+
+    # Sin watermark registrado se parte de lo que ya esta cargado en el hecho
+    if tabla == 'mensajeria_servicio':
+        with conn_olap.connect() as con:
+            ultimo_id_olap = con.execute(text('select max(id_servicio) from hecho_servicios;')).fetchone()[0]
+        print(f'Sin watermark para {tabla}, se usa el ultimo id de hecho_servicios: {ultimo_id_olap}')
+        return ultimo_id_olap
+    return None
+
+
+def actualizar_watermark(conn_olap: Engine, tabla: str, ultimo_id: int):
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :param tabla: tabla del OLTP a la que pertenece el watermark
+    :param ultimo_id: ultimo id procesado de la tabla
+    :return: void, guarda (o reemplaza) el watermark de la tabla
+    """
+    query = text(f'''
+        insert into {TABLA_WATERMARK} (tabla, ultimo_id, actualizado)
+        values (:tabla, :ultimo_id, now())
+        on conflict (tabla) do update
+        set ultimo_id = excluded.ultimo_id, actualizado = excluded.actualizado;
+    ''')
+    with conn_olap.connect() as con:
+        con.execute(query, {'tabla': tabla, 'ultimo_id': int(ultimo_id)})
+        con.commit()
+    print(f'Watermark de la tabla {tabla} actualizado a {ultimo_id}')
+
+
+def ultimo_id(conn_oltp: Engine, tabla: str):
+    """
+    :param conn_oltp: sqlalchemy engine de la base de datos OLTP
+    :param tabla: tabla del OLTP con columna id
+    :return: mayor id de la tabla, None si esta vacia
+    """
+    with conn_oltp.connect() as con:
+        return con.execute(text(f'select max(id) from {tabla};')).fetchone()[0]
+
+
+def rango_ids_servicio(conn_oltp: Engine) -> tuple:
+    """
+    :param conn_oltp: sqlalchemy engine de la base de datos OLTP
+    :return: (primer id, ultimo id) de mensajeria_servicio, (None, None) si esta vacia
+    """
+    with conn_oltp.connect() as con:
+        return tuple(con.execute(text('select min(id), max(id) from mensajeria_servicio;')).fetchone())
+
+
+def rango_fechas_tiempo(conn_olap: Engine) -> tuple:
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :return: (primera fecha, ultima fecha) cargadas en dim_tiempo, (None, None) si la dimension esta vacia
+    """
+    with conn_olap.connect() as con:
+        return tuple(con.execute(text('select min(fecha), max(fecha) from dim_tiempo;')).fetchone())
+
+
+def llaves_tiempo_legadas(conn_olap: Engine) -> bool:
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :return: True si dim_tiempo o hecho_servicios aun tienen llaves SERIAL en lugar de AAAAMMDDHH
+    """
+    with conn_olap.connect() as con:
+        for tabla in ('dim_tiempo', 'hecho_servicios'):
+            # min sobre la llave primaria o el indice del hecho, no recorre la tabla
+            minima = con.execute(text(f'select min(key_dim_tiempo) from {tabla};')).fetchone()[0]
+            if minima is not None and minima < LLAVE_TIEMPO_MINIMA:
+                return True
+    return False
+
+
+def verificar_llaves_tiempo(conn_olap: Engine):
+    """
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP
+    :return: void, falla si el OLAP tiene llaves de dim_tiempo anteriores al formato AAAAMMDDHH
+    """
+    if llaves_tiempo_legadas(conn_olap):
+        raise RuntimeError('dim_tiempo tiene llaves SERIAL de una version anterior; las llaves ahora son AAAAMMDDHH '
+                           'y las cargas nuevas fallarian por llave foranea. Ejecute una vez '
+                           '"python main.py migrar-tiempo" antes de volver a cargar.')
+
+
+def migrar_llaves_tiempo(conn_olap: Engine):
+    """
+    Migracion unica de dim_tiempo de llaves SERIAL a AAAAMMDDHH: agrega las filas con la llave nueva,
+    reasigna las llaves del hecho y borra las filas viejas, todo en una transaccion. Los agregados se
+    vacian para que el siguiente lote los reconstruya con los periodos de las llaves nuevas.
+
+    :param conn_olap: sqlalchemy engine de la base de datos OLAP (PostgreSQL)
+    :return: void
+    """
+    if not llaves_tiempo_legadas(conn_olap):
+        print('dim_tiempo ya usa llaves AAAAMMDDHH, no hay nada que migrar')
+        return
+    llave_nueva = "cast(to_char({t}.fecha, 'YYYYMMDD') as integer) * 100 + {t}.hora_dia"
+    tnames = inspect(conn_olap).get_table_names()
+    with conn_olap.begin() as con:
+        # Las filas nuevas existen antes de reasignar el hecho, la llave foranea se cumple en cada paso
+        filas = con.execute(text(f'insert into dim_tiempo (key_dim_tiempo, fecha, dia_semana, mes, hora_dia) '
+                                 f'select {llave_nueva.format(t="t")}, t.fecha, t.dia_semana, t.mes, t.hora_dia '
+                                 f'from dim_tiempo t where t.key_dim_tiempo < :minima '
+                                 f'on conflict (key_dim_tiempo) do nothing;'),
+                            {'minima': LLAVE_TIEMPO_MINIMA}).rowcount
+        print(f'dim_tiempo: {filas} filas con llave AAAAMMDDHH')
+        hechos = con.execute(text(f'update hecho_servicios as h set key_dim_tiempo = {llave_nueva.format(t="t")} '
+                                  f'from dim_tiempo t '
+                                  f'where h.key_dim_tiempo = t.key_dim_tiempo and t.key_dim_tiempo < :minima;'),
+                             {'minima': LLAVE_TIEMPO_MINIMA}).rowcount
+        print(f'hecho_servicios: {hechos} llaves reasignadas')
+        con.execute(text('delete from dim_tiempo where key_dim_tiempo < :minima;'), {'minima': LLAVE_TIEMPO_MINIMA})
+        # La llave ya no la genera la secuencia del SERIAL
+        con.execute(text('alter table dim_tiempo alter column key_dim_tiempo drop default;'))
+        for tname in rollups.ROLLUPS:
+            if tname in tnames:
+                con.execute(text(f'delete from {tname};'))
+    print('Migracion de llaves de dim_tiempo terminada')
+
 
 def push_dimensions(co_sa, etl_conn):
     dim_ips = extract.extract_ips(co_sa)
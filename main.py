@@ -1,72 +1,109 @@
+import argparse
+import signal
+import sys
+import threading
+import uuid
+
 import pandas as pd
-import datetime
-from datetime import date
-from sqlalchemy import create_engine, inspect, text
-from sqlalchemy.engine import Engine
 import yaml
-from etl import extract, transform, load, utils_etl
-import psycopg2
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from etl import checkpoint, extract, transform, load, lookup, metrics, pipeline, utils_etl
 
 pd.set_option('display.max_rows', 100)
 pd.set_option('display.max_columns', 100)
 
 
-# ---- Carga de Configuración ----
-# Cargar configuración de base de datos desde archivo YAML
-with open('config.yml', 'r') as f:
-    config = yaml.safe_load(f)
-    config_oltp = config['MENSAJERIA_OLTP']  # Configuración base de datos OLTP
-    config_olap = config['MENSAJERIA_OLAP']  # Configuración base de datos OLAP
-
-# ---- Configuración de Conexiones a Bases de Datos ----
-# Construir URLs de conexión para ambas bases de datos
-url_oltp = (f"{config_oltp['drivername']}://{config_oltp['user']}:{config_oltp['password']}@{config_oltp['host']}:"
-          f"{config_oltp['port']}/{config_oltp['dbname']}")
-url_olap = (f"{config_olap['drivername']}://{config_olap['user']}:{config_olap['password']}@{config_olap['host']}:"
-           f"{config_olap['port']}/{config_olap['dbname']}")
-
-# Crear motores de conexión SQLAlchemy
-oltp_conn = create_engine(url_oltp)
-olap_conn = create_engine(url_olap)
-
-# ---- Inicialización del Esquema de Base de Datos ----
-# Verificar si existen las tablas en la base de datos OLAP
-print("verificando si existen tablas en la base de datos OLAP")
-inspector = inspect(olap_conn)
-tnames = inspector.get_table_names()
-
-# Si no existen tablas, crearlas desde los scripts SQL
-if not tnames:
-    print("no existen tablas en la base de datos OLAP, creando tablas")
-    # Crear conexión directa para ejecutar scripts SQL
-    conn = psycopg2.connect(dbname=config_olap['dbname'], user=config_olap['user'], password=config_olap['password'],
-                            host=config_olap['host'], port=config_olap['port'])
-    cur = conn.cursor()
-    
-    # Cargar y ejecutar scripts de creación SQL desde archivo YAML
-    with open('sqlscripts.yml', 'r') as f:
+def cargar_config(ruta: str = 'config.yml') -> dict:
+    """
+    :param ruta: archivo YAML de configuracion
+    :return: configuracion del ETL
+    """
+    # ---- Carga de Configuración ----
+    with open(ruta, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def crear_tablas(olap_conn: Engine, config_olap: dict, ruta_scripts: str = 'sqlscripts.yml'):
+    """
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config_olap: configuracion de la base de datos OLAP
+    :param ruta_scripts: archivo YAML con los scripts de creacion
+    :return: void, crea las tablas y los indices del OLAP que no existan
+    """
+    # ---- Inicialización del Esquema de Base de Datos ----
+    # Verificar si existen las tablas en la base de datos OLAP
+    print("verificando si existen tablas en la base de datos OLAP")
+    inspector = inspect(olap_conn)
+    tnames = inspector.get_table_names()
+
+    # Crear las tablas que no existan desde los scripts SQL
+    with open(ruta_scripts, 'r') as f:
         tablas_olap = yaml.safe_load(f)
-        for key, val in tablas_olap.items():
+    # Los indices no son tablas, se crean aparte cuando ya existen sus tablas
+    indices = tablas_olap.pop('INDICES', None) or {}
+    tablas_faltantes = {key: val for key, val in tablas_olap.items() if key not in tnames}
+
+    if not tablas_faltantes:
+        print("Ya existen tablas en la base de datos OLAP: ", tnames)
+    else:
+        print("faltan tablas en la base de datos OLAP, creando tablas: ", list(tablas_faltantes))
+        # psycopg2 solo se importa cuando hay scripts que ejecutar
+        import psycopg2
+
+        # Crear conexión directa para ejecutar scripts SQL
+        conn = psycopg2.connect(dbname=config_olap['dbname'], user=config_olap['user'], password=config_olap['password'],
+                                host=config_olap['host'], port=config_olap['port'])
+        cur = conn.cursor()
+
+        # Ejecutar scripts de creación SQL de las tablas faltantes
+        for key, val in tablas_faltantes.items():
             print("creando tabla: ", key)
             cur.execute(val)
             conn.commit()
-    cur.close()
-    conn.close()
-else:
-    print("Ya existen tablas en la base de datos OLAP: ", tnames)
-
-# ---- Procesamiento de Datos ----
-# Verificar si hay nuevos datos en la base de datos OLTP
-if utils_etl.new_data(oltp_conn, olap_conn):
-    print("hay nuevos datos en la base de datos OLTP")
-    # ---- Carga de Dimensiones ----
-    # Extraer datos de dimensiones de la base de datos OLTP
-    if config['LOAD_DIMENSIONS']:
+        cur.close()
+        conn.close()
+
+    crear_indices(olap_conn, indices)
+
+
+def crear_indices(olap_conn: Engine, indices: dict):
+    """
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param indices: nombre del indice -> script de creacion (INDICES en sqlscripts.yml)
+    :return: void, crea los indices que no existan
+    """
+    inspector = inspect(olap_conn)
+    existentes = {indice['name'] for tname in inspector.get_table_names() for indice in inspector.get_indexes(tname)}
+    indices_faltantes = {key: val for key, val in indices.items() if key not in existentes}
+    if not indices_faltantes:
+        return
+
+    with olap_conn.begin() as con:
+        for key, val in indices_faltantes.items():
+            print("creando indice: ", key)
+            con.execute(text(val))
+
+
+def cargar_dimensiones(oltp_conn: Engine, olap_conn: Engine, config: dict):
+    """
+    :param oltp_conn: sqlalchemy engine de la base de datos OLTP
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config: configuracion del ETL (config.yml)
+    :return: void, extrae, transforma y carga dim_mensajero, dim_cliente y dim_sede
+    """
+    if checkpoint.etapa('dimensiones') == 'transform':
+        print("leyendo dimensiones transformadas desde los checkpoints")
+        dimensiones = checkpoint.leer('dimensiones', 'transform')
+    else:
         print("Extraer datos de la base de datos OLTP")
-        tablas_mensajero = extract.extract(['clientes_mensajeroaquitoy', 'auth_user'], oltp_conn)
-        tablas_clientes = extract.extract(['cliente'], oltp_conn)
-        tablas_sede = extract.extract(['sede', 'ciudad'], oltp_conn)
-        tablas_tiempo = extract.extract(['mensajeria_servicio'], oltp_conn)
+        # Las tablas de las tres dimensiones se leen a la vez
+        tablas_dimensiones = extract.extract(['clientes_mensajeroaquitoy', 'auth_user', 'cliente', 'sede', 'ciudad'],
+                                             oltp_conn, config['EXTRACT_SPEC'], workers=config['EXTRACT_WORKERS'])
+        tablas_mensajero = tablas_dimensiones[0:2]
+        tablas_clientes = tablas_dimensiones[2:3]
+        tablas_sede = tablas_dimensiones[3:5]
 
         print("transformando datos")
         dim_mensajero = transform.transform_mensajero(tablas_mensajero)
@@ -75,31 +112,193 @@ if utils_etl.new_data(oltp_conn, olap_conn):
         print("total clientes: ", len(dim_cliente))
         dim_sede = transform.transform_sede(tablas_sede)
         print("total sedes: ", len(dim_sede))
-        dim_tiempo = transform.transform_tiempo(tablas_tiempo)
-        print("total tiempo: ", len(dim_tiempo))
 
-        print("cargando datos en la base de datos OLAP")
-        load.load(dim_mensajero, etl_conn=olap_conn, tname='dim_mensajero', replace=True)
-        load.load(dim_cliente, etl_conn=olap_conn, tname='dim_cliente', replace=True)
-        load.load(dim_sede, etl_conn=olap_conn, tname='dim_sede', replace=True)
-        load.load(dim_tiempo, etl_conn=olap_conn, tname='dim_tiempo', replace=True)
+        dimensiones = {'dim_mensajero': dim_mensajero, 'dim_cliente': dim_cliente, 'dim_sede': dim_sede}
+        checkpoint.guardar('dimensiones', 'transform', dimensiones)
+        checkpoint.completar('dimensiones', 'transform')
 
-    # ---- Carga de Hechos ----
-    print("Extraer datos de la base de datos OLTP para el hecho de servicios")
-    tablas_servicios_oltp = extract.extract(['mensajeria_servicio', 'clientes_usuarioaquitoy', 'mensajeria_estadosservicio', 'mensajeria_novedadesservicio'], oltp_conn)
-    print("Extraer datos de la base de datos OLAP para las dimensiones")
-    tablas_dimensiones_olap = extract.extract(['dim_tiempo', 'dim_sede', 'dim_cliente', 'dim_mensajero'], olap_conn)
+    print("cargando datos en la base de datos OLAP")
+    for tname, dim in dimensiones.items():
+        if config['MERGE_DIMENSIONS']:
+            # Solo se escriben los cambios, las llaves subrogadas existentes se conservan
+            natural_key = lookup.DIMENSIONES[tname][0]
+            cambios = load.merge_dimension(dim, etl_conn=olap_conn, tname=tname, natural_key=natural_key)
+            # Actualizar atributos no cambia id natural -> llave subrogada; solo las filas nuevas agregan llaves
+            if cambios['nuevos']:
+                lookup.invalidar(tname, config['LOOKUP_CACHE_DIR'])
+        else:
+            load.load(dim, etl_conn=olap_conn, tname=tname, replace=True,
+                      method=config['LOAD_METHOD'].get(tname, 'insert'))
+            lookup.invalidar(tname, config['LOOKUP_CACHE_DIR'])
+    checkpoint.completar('dimensiones', 'load')
+
+
+def ejecutar(oltp_conn: Engine, olap_conn: Engine, config: dict, reanudar: bool = False) -> bool:
+    """
+    Ejecuta un lote del ETL si el OLTP tiene datos nuevos.
 
-    print("transformando datos para el hecho de servicios")
-    hecho_servicios = transform.transform_hecho_servicios(tablas_servicios_oltp + tablas_dimensiones_olap)
-    print("total servicios: ", len(hecho_servicios))
-    #print(hecho_servicios.head(10))
+    :param oltp_conn: sqlalchemy engine de la base de datos OLTP
+    :param olap_conn: sqlalchemy engine de la base de datos OLAP
+    :param config: configuracion del ETL (config.yml)
+    :param reanudar: retoma la ultima ejecucion sin terminar desde sus checkpoints
+    :return: True si habia datos nuevos y se cargaron
+    """
+    # ---- Procesamiento de Datos ----
+    # Verificar si hay nuevos datos en la base de datos OLTP
+    if not utils_etl.new_data(oltp_conn, olap_conn, incremental=config['INCREMENTAL']):
+        print("no hay nuevos datos en la base de datos OLTP")
+        return False
 
-    print("cargando datos en la base de datos OLAP para el hecho de servicios")
-    load.load(hecho_servicios, etl_conn=olap_conn, tname='hecho_servicios', replace=False)
+    print("hay nuevos datos en la base de datos OLTP")
+    # ---- Checkpoints ----
+    # La salida de cada etapa se guarda por ejecución y watermark para poder retomarla con --resume
+    watermark = utils_etl.obtener_watermark(olap_conn, 'mensajeria_servicio') if config['INCREMENTAL'] else None
+    checkpoint.iniciar(config['CHECKPOINT'], metrics.RUN_ID, watermark, reanudar=reanudar)
+
+    # ---- Carga de Dimensiones ----
+    if config['LOAD_DIMENSIONS'] and checkpoint.etapa('dimensiones') != 'load':
+        cargar_dimensiones(oltp_conn, olap_conn, config)
 
+    # ---- Carga de Hechos ----
+    pipeline.cargar_hechos(oltp_conn, olap_conn, config)
+    checkpoint.finalizar()
 
     print("Carga Satisfactoria hecho de servicios")
+    return True
+
+
+def conectar(config: dict) -> tuple:
+    """
+    :param config: configuracion del ETL (config.yml)
+    :return: (engine OLTP, engine OLAP) con el pool configurado y el esquema del OLAP creado
+    """
+    # ---- Configuración de Conexiones a Bases de Datos ----
+    oltp_conn = utils_etl.crear_engine(config['MENSAJERIA_OLTP'], config['POOL'])
+    olap_conn = utils_etl.crear_engine(config['MENSAJERIA_OLAP'], config['POOL'])
+    crear_tablas(olap_conn, config['MENSAJERIA_OLAP'])
+    # Un OLAP con llaves de dim_tiempo de una version anterior se migra antes de cargar
+    utils_etl.verificar_llaves_tiempo(olap_conn)
+    return oltp_conn, olap_conn
+
+
+def run_once(args: argparse.Namespace, config: dict):
+    """
+    :param args: opciones de la linea de comandos
+    :param config: configuracion del ETL (config.yml)
+    :return: void, ejecuta un solo lote y termina
+    """
+    # Repetir la transformación sobre las extracciones guardadas, sin tocar las bases de datos
+    if args.from_cache:
+        pipeline.transformar_desde_cache(config, args.run_id)
+        return
+
+    oltp_conn, olap_conn = conectar(config)
+    try:
+        ejecutar(oltp_conn, olap_conn, config, reanudar=args.resume)
+    finally:
+        # Guardar las métricas de la ejecución en el historial del OLAP
+        if config['METRICS']['historial']:
+            metrics.guardar_historial(olap_conn)
+        oltp_conn.dispose()
+        olap_conn.dispose()
+
+
+def serve(args: argparse.Namespace, config: dict):
+    """
+    Proceso de larga duracion: revisa el OLTP cada intervalo y carga los lotes nuevos reutilizando
+    los engines (y sus pools) y los mapas de llaves en memoria. SIGTERM o SIGINT terminan el lote
+    en curso y detienen el proceso.
+
+    :param args: opciones de la linea de comandos
+    :param config: configuracion del ETL (config.yml)
+    :return: void
+    """
+    intervalo = args.intervalo if args.intervalo is not None else config['SERVE']['intervalo_s']
+    detener = threading.Event()
+
+    def senal(signum, frame):
+        print(f"Señal {signal.Signals(signum).name} recibida, se detiene al terminar el lote en curso")
+        detener.set()
+
+    signal.signal(signal.SIGTERM, senal)
+    signal.signal(signal.SIGINT, senal)
+
+    oltp_conn, olap_conn = conectar(config)
+    reanudar = args.resume
+    print(f"Revisando datos nuevos cada {intervalo} s")
+    try:
+        while not detener.is_set():
+            # Cada lote tiene su propio run id en las metricas y los checkpoints
+            metrics.configurar(config['METRICS']['destino'], run_id=uuid.uuid4().hex)
+            try:
+                ejecutar(oltp_conn, olap_conn, config, reanudar=reanudar)
+            except Exception as e:
+                # Un lote fallido se retoma desde sus checkpoints en la siguiente revision
+                print(f"Error en el lote {metrics.RUN_ID}: {e!r}")
+                reanudar = True
+            else:
+                reanudar = False
+            finally:
+                if config['METRICS']['historial']:
+                    metrics.guardar_historial(olap_conn)
+            detener.wait(intervalo)
+    finally:
+        oltp_conn.dispose()
+        olap_conn.dispose()
+        print("Proceso detenido")
+
+
+def migrar_tiempo(args: argparse.Namespace, config: dict):
+    """
+    :param args: opciones de la linea de comandos
+    :param config: configuracion del ETL (config.yml)
+    :return: void, migra una sola vez las llaves de dim_tiempo de SERIAL a AAAAMMDDHH
+    """
+    olap_conn = utils_etl.crear_engine(config['MENSAJERIA_OLAP'], config['POOL'])
+    try:
+        utils_etl.migrar_llaves_tiempo(olap_conn)
+    finally:
+        olap_conn.dispose()
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='ETL de mensajeria del OLTP al OLAP')
+    parser.add_argument('--config', default='config.yml', help='archivo de configuracion')
+    comandos = parser.add_subparsers(dest='comando')
+
+    run_once_parser = comandos.add_parser('run-once', help='ejecuta un lote del ETL y termina (por defecto)')
+    run_once_parser.add_argument('--from-cache', action='store_true',
+                                 help='transforma las extracciones guardadas en los checkpoints sin conectarse a las bases de datos')
+    run_once_parser.add_argument('--run-id', default=None,
+                                 help='ejecucion de los checkpoints a usar con --from-cache (por defecto la mas reciente)')
+
+    serve_parser = comandos.add_parser('serve', help='revisa el OLTP periodicamente y carga los lotes nuevos')
+    serve_parser.add_argument('--intervalo', type=float, default=None,
+                              help='segundos entre revisiones (por defecto SERVE.intervalo_s de config.yml)')
+
+    comandos.add_parser('migrar-tiempo', help='migra una sola vez las llaves de dim_tiempo de SERIAL a AAAAMMDDHH')
+
+    for comando in (parser, run_once_parser, serve_parser):
+        comando.add_argument('--resume', action='store_true', default=argparse.SUPPRESS,
+                             help='retoma la ultima ejecucion sin terminar desde su ultima etapa completada')
+
+    # Sin comando se ejecuta un solo lote, como antes
+    args = parser.parse_args(argv)
+    args.resume = getattr(args, 'resume', False)
+    args.from_cache = getattr(args, 'from_cache', False)
+    args.run_id = getattr(args, 'run_id', None)
+
+    config = cargar_config(args.config)
+    # Métricas de cada etapa como líneas JSON (stdout o archivo)
+    metrics.configurar(config['METRICS']['destino'])
+
+    if args.comando == 'serve':
+        serve(args, config)
+    elif args.comando == 'migrar-tiempo':
+        migrar_tiempo(args, config)
+    else:
+        run_once(args, config)
+
 
-else:
-    print("no hay nuevos datos en la base de datos OLTP")
+if __name__ == '__main__':
+    main(sys.argv[1:])